@@ -1,21 +1,333 @@
 
 import asyncio
+import collections
+import fnmatch
 import websockets
 import os
 import json
 import logging
+import random
+import re
 import aiohttp
 import ssl
+import time
+import logs
 import proton
 from rhmsg.activemq.producer import AMQProducer
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+class Envelope(object):
+    # One received frame, decoded once. id, headers and route are read from the envelope,
+    # the webhook payload is only decoded when it is used, so events of other branches never decode it.
+
+    def __init__(self, message, raw=None):
+        # message is the decoded envelope, raw the still encoded payload json when it is not decoded yet
+        self.message = message
+        if raw is None and message.get('v') != 2:
+            # v1 envelope carries the webhook payload as json string
+            raw = message.get('payload')
+        self.raw = raw
+        self._payload = message.get('payload') if raw is None else None
+        self.id = message.get('id')
+        self.headers = message.get('headers') or {}
+        self.event = self.headers.get('X-Github-Event')
+
+    @property
+    def payload(self):
+        if self._payload is None and self.raw is not None:
+            self._payload = json.loads(self.raw)
+        return self._payload
+
+    @property
+    def route(self):
+        # [repository, ref, event], read from the payload for v1 envelopes and older servers
+        route = self.message.get('route')
+        if route is None:
+            payload = self.payload if isinstance(self.payload, dict) else {}
+            route = self.message['route'] = [repositoryName(payload), payload.get('ref'), self.event]
+        return route
+
+    @property
+    def repository(self):
+        return self.route[0]
+
+    @property
+    def ref(self):
+        return self.route[1]
+
+
+def decodeJsonFrame(frame):
+    # Server splices the payload last into v2 json frames, so only the envelope before it is
+    # decoded here. Frames not split that way are decoded whole.
+    position = frame.find(', "payload": ')
+    if position != -1:
+        try:
+            message = json.loads(frame[:position] + '}')
+            if message.get('v') == 2:
+                return Envelope(message, frame[position + len(', "payload": '):-1])
+        except ValueError:
+            pass
+    return Envelope(json.loads(frame))
+
+# Websocket subprotocols in order of preference with the decoder of their frames into an Envelope,
+# server picks envelope version and encoding from them
+DECODERS = collections.OrderedDict()
+if msgpack is not None:
+    DECODERS['tightbeam.v2+msgpack'] = lambda frame: Envelope(msgpack.unpackb(frame, raw=False))
+if cbor2 is not None:
+    DECODERS['tightbeam.v2+cbor'] = lambda frame: Envelope(cbor2.loads(frame))
+DECODERS['tightbeam.v2+json'] = decodeJsonFrame
+DECODERS['tightbeam.v1+json'] = lambda frame: Envelope(json.loads(frame))
+SUBPROTOCOLS = list(DECODERS)
+# Errors of a lost or refused connection to server, the client reconnects after them
+CONNECTION_ERRORS = (websockets.ConnectionClosed, websockets.InvalidHandshake, OSError, asyncio.TimeoutError)
+
+# Logger categories, see LOG_LEVELS / LOG_SAMPLING in logs.py
+CONNECTION_LOGGER = logging.getLogger('tightbeam.client.connection')
+EVENT_LOGGER = logging.getLogger('tightbeam.client.event')
+TRIGGER_LOGGER = logging.getLogger('tightbeam.client.trigger')
+
+class RefMatcher(object):
+    # GH_BRANCH compiled once: branch names ( main ), branch globs ( release/* ) and full refs or ref
+    # globs for tags ( refs/tags/v1.* ), separated with ",". Exact refs are looked up in a set, globs in
+    # a trie of their literal leading path segments, so a ref is only tried against globs sharing its prefix.
+
+    def __init__(self, branches):
+        self.exact = set()
+        # path segment -> child node, None -> compiled globs whose literal prefix ends at this node
+        self.globs = {}
+        for entry in (x.strip() for x in branches.split(',')):
+            if not entry:
+                continue
+            ref = entry if entry.startswith('refs/') else 'refs/heads/' + entry
+            if not any(x in ref for x in '*?['):
+                self.exact.add(ref)
+                continue
+            node = self.globs
+            for segment in ref.split('/'):
+                if any(x in segment for x in '*?['):
+                    break
+                node = node.setdefault(segment, {})
+            node.setdefault(None, []).append(re.compile(fnmatch.translate(ref)))
+
+    def refs(self):
+        # refs to subscribe to on server, which matches exact refs only, so None for all refs when there are globs
+        return None if self.globs else sorted(self.exact)
+
+    def match(self, ref):
+        if not ref:
+            return False
+        if ref in self.exact:
+            return True
+        node = self.globs
+        for segment in ref.split('/'):
+            if any(x.match(ref) for x in node.get(None, ())):
+                return True
+            node = node.get(segment)
+            if node is None:
+                return False
+        return any(x.match(ref) for x in node.get(None, ()))
+
+class Coalescer(object):
+    # Triggers of one (repository, branch) arriving within `window` seconds of each other
+    # are sent once, with the latest head commit. Triggers for a head commit that is already
+    # waiting, or was the last one handed over within `ttl` seconds and not failed, are dropped.
+    # The last head is compared when the window closes, so a branch moved away and back to it
+    # within the window is not built again, and the head it moved away to is not built at all.
+
+    def __init__(self, window, send, ttl=3600):
+        self.window = window
+        self.ttl = ttl
+        # send(key, *args, done=done) hands one trigger over for sending, done(sent) tells whether it was sent
+        self.send = send
+        # (repository, branch) -> (head commit, args) waiting for the window to close
+        self.pending = {}
+        # (repository, branch) -> (last head commit handed over, expiry time)
+        self.heads = {}
+        self.received = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.duplicates = 0
+
+    def submit(self, key, head, *args):
+        self.received += 1
+        waiting = self.pending.get(key)
+        if head is not None and head == (waiting[0] if waiting is not None else self.last(key)):
+            self.duplicate(key, head)
+            return
+        self.pending[key] = (head, args)
+        if waiting is not None:
+            self.coalesced += 1
+            return
+        asyncio.get_event_loop().call_later(self.window, self.flush, key)
+
+    def last(self, key):
+        # Last head commit handed over for key, None once it expired
+        last, expires = self.heads.get(key, (None, 0))
+        if last is not None and expires <= time.time():
+            del self.heads[key]
+            return None
+        return last
+
+    def duplicate(self, key, head):
+        self.duplicates += 1
+        TRIGGER_LOGGER.info('-- Build for %s %s already triggered: %s', key, head, logs.Fields(**self.stats()))
+
+    def flush(self, key):
+        head, args = self.pending.pop(key)
+        if head is not None and head == self.last(key):
+            self.duplicate(key, head)
+            return
+        self.heads[key] = (head, time.time() + self.ttl)
+        self.sent += 1
+        TRIGGER_LOGGER.info('-- Build for %s %s queued: %s', key, head, logs.Fields(**self.stats()))
+        self.send(key, *args, done=lambda sent: self.done(key, head, sent))
+
+    def done(self, key, head, sent):
+        # A failed or dropped trigger is not a duplicate, the head can be triggered again
+        if not sent and self.heads.get(key, (None,))[0] == head:
+            del self.heads[key]
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'duplicates': self.duplicates,
+            'saved': self.coalesced + self.duplicates
+        }
+
+class Dispatcher(object):
+    # Sends triggers from bounded queues drained by one coroutine each. Triggers of one
+    # (repository, branch) always use the same queue, so they are sent in order, and reading
+    # the websocket never waits for a slow trigger endpoint. A queued trigger is replaced by a
+    # newer one of the same key, a trigger of a new key finding its queue full is dropped.
+
+    def __init__(self, workers, max_queued, send, report_interval=0):
+        # async send(*args) sends one trigger
+        self.send = send
+        self.max_queued = max(1, max_queued // workers)
+        # [(submit time, key, args)] per worker, with the event waking the worker up
+        self.queues = [collections.deque() for _ in range(workers)]
+        self.ready = [asyncio.Event() for _ in range(workers)]
+        self.dispatched = 0
+        self.failed = 0
+        self.superseded = 0
+        self.dropped = 0
+        # seconds from submit until sent of recent triggers
+        self.latencies = collections.deque(maxlen=1000)
+        for index in range(workers):
+            asyncio.ensure_future(self.run(index))
+        if report_interval > 0:
+            asyncio.ensure_future(self.report(report_interval))
+
+    def submit(self, key, *args, done=None):
+        # done(sent) is called once the trigger is sent, failed, replaced or dropped
+        done = done or (lambda sent: None)
+        index = hash(key) % len(self.queues)
+        queue = self.queues[index]
+        for position, (submitted, queued_key, _, replaced) in enumerate(queue):
+            if queued_key == key:
+                # the queued trigger is not sent yet, the newer one takes its place
+                queue[position] = (submitted, key, args, done)
+                self.superseded += 1
+                replaced(False)
+                return
+        if len(queue) >= self.max_queued:
+            self.dropped += 1
+            TRIGGER_LOGGER.warning('-- Trigger queue full, trigger for %s dropped: %s', key, logs.Fields(**self.stats()))
+            done(False)
+            return
+        queue.append((asyncio.get_event_loop().time(), key, args, done))
+        self.ready[index].set()
+
+    async def run(self, index):
+        loop = asyncio.get_event_loop()
+        queue, ready = self.queues[index], self.ready[index]
+        while True:
+            if not queue:
+                ready.clear()
+                await ready.wait()
+                continue
+            submitted, key, args, done = queue.popleft()
+            started = loop.time()
+            try:
+                await self.send(*args)
+                self.dispatched += 1
+                done(True)
+            except Exception:
+                self.failed += 1
+                TRIGGER_LOGGER.exception('-- Build trigger for %s failed', key)
+                done(False)
+            finished = loop.time()
+            self.latencies.append(finished - submitted)
+            TRIGGER_LOGGER.info('-- Build triggered for %s: %s', key, logs.Fields(
+                wait_ms=round((started - submitted) * 1000, 1), send_ms=round((finished - started) * 1000, 1),
+                queued=self.queued()))
+
+    async def report(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            TRIGGER_LOGGER.info('-- Trigger dispatch: %s', logs.Fields(**self.stats()))
+
+    def queued(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        return {
+            'queued': self.queued(),
+            'dispatched': self.dispatched,
+            'failed': self.failed,
+            'superseded': self.superseded,
+            'dropped': self.dropped,
+            'latency_p50_ms': round(latencies[len(latencies) // 2] * 1000, 1) if latencies else None,
+            'latency_p99_ms': round(latencies[int(len(latencies) * 0.99)] * 1000, 1) if latencies else None
+        }
+
 async def start():
-    # Github Branch name from System Variable
+    # Github Branch names, branch globs or tag refs ( "," separated ) from System Variable
     branch_name = os.getenv('GH_BRANCH','')
+    # Matcher of watched refs, compiled once
+    matcher = RefMatcher(branch_name)
     # Provided URL for triggering build proccess or starting pipeline from System Variable
     build_url = os.getenv('URL_TRIGGER','')
     # WebSockets Endpoint URL provided from System Variable
     ws_endpoint = os.getenv('WS_SERVER', "")
+    # Github Repositories ( "owner/name" separated with "," ) to receive events for, empty for all
+    repositories = os.getenv('GH_REPOSITORY', '')
+    # Github webhook event types separated with "," to receive from server
+    events = os.getenv('GH_EVENTS', 'push')
+    # File keeping the last received event id, so missed events are resent after reconnect
+    event_id_file = os.getenv('EVENT_ID_FILE', '')
+    # Webhook payload fields ( dotted paths separated with "," ) requested from server, empty for whole payload
+    fields = os.getenv('GH_FIELDS', '')
+    # Filter expression the server evaluates on every event, e.g. "pusher.name != dependabot[bot]"
+    expression = os.getenv('GH_FILTER', '')
+    # Seconds to collect pushes to one branch before triggering a single build for the latest of them
+    trigger_window = float(os.getenv('TRIGGER_WINDOW', '5'))
+    # Seconds a triggered head commit is remembered, so pushes of it are not triggered again
+    trigger_dedup_ttl = float(os.getenv('TRIGGER_DEDUP_TTL', '3600'))
+    # Number of triggers sent at the same time, and how many can wait to be sent
+    dispatch_workers = int(os.getenv('DISPATCH_WORKERS', '4'))
+    dispatch_queue_size = int(os.getenv('DISPATCH_QUEUE_SIZE', '100'))
+    # Seconds between logs of trigger queue depth and latency, 0 to disable them
+    dispatch_stats_interval = float(os.getenv('DISPATCH_STATS_INTERVAL', '60'))
+    # Seconds between websocket pings, and to wait for their pong before the server is considered gone
+    ping_interval = float(os.getenv('WS_PING_INTERVAL', '20'))
+    ping_timeout = float(os.getenv('WS_PING_TIMEOUT', '20'))
+    # Seconds before the first reconnect to server, doubled with every failed attempt up to RECONNECT_MAX_DELAY
+    reconnect_delay = float(os.getenv('RECONNECT_DELAY', '1'))
+    reconnect_max_delay = float(os.getenv('RECONNECT_MAX_DELAY', '60'))
     # List of Allowed Headers from Github webhooks POST request
     alowed = ["Accept", "User-Agent", "X-Github-Event", "X-Github-Delivery", "Content-Type", "X-Hub-Signature"]
     # UMB certificate files & endpoint
@@ -26,69 +338,167 @@ async def start():
     amqp_url = os.getenv("AMQP_URL","")
     amqp_topic = os.getenv("AMQP_TOPIC","")
     #SSL connection present:
-    print("--- SSL connection present: {}".format(proton.SSL.present()))
-    print("--- RH Variables: rh_cert:{}  rh_key:{} rh_crt:{} amqp_url:{} amqp_topic:{}".format(rh_cert,rh_key,rh_crt,amqp_url,topic+amqp_topic))
-
-    # Opening WebSocket Connection to WebSocket server
-    async with websockets.connect(ws_endpoint) as websocket:
-        logging.warning('--- Opened Connection to Server ---')
-        # sending websocket message to server
-        await websocket.send(json.dumps({'msg':'TEST MESSAGE'}))
-        while True:
-            # Listening for recived messages from websocket server
-            response = await websocket.recv()
-            logRecivedMessage(response) # Log websocket recived message
-            data = json.loads(response)
-            payload = {}
-            payload["payload"] = json.loads(data["payload"])
-            logRecivedMessagePayload(payload["payload"]) # log websocket message payload from webhook
-            # REF Github branch for building project
-            ref = payload["payload"]["ref"].split("/")[2]
-            # Create Dictionary of allowed headers from rerouted webhook POST request
-            payload['headers'] =  {x:y for x,y in data["headers"].items() if x in alowed}
-            # Connection from websocket server is closed so terminate this iterations
-            if response is None: break
-            else:
-                if branch_name != '' and ref in branch_name.split(","):
-                    amqp_props = dict()
-                    amqp_props['subject'] = payload['payload']['head_commit']['message']
-                    amqp_message = str(payload)  # "Test Message"
-                    producer = AMQProducer(
-                        urls=amqp_url,
-                        certificate=rh_crt,
-                        private_key=rh_key,
-                        trusted_certificates=rh_cert,
-                        topic=topic+amqp_topic
-                    )
-                    # send AMQP message to Red Hat UMB service
-                    producer.send_msg(amqp_props,amqp_message.encode("utf-8"))
-                else:
-                    logDifferentBranchName(ref,branch_name)
-
-
-def logRecivedMessage(msg):
-    resp_txt = str(msg)
-    rspn = json.loads(resp_txt.replace("\'", "\""))
-    logging.warning("-- New Code Event ID: {}".format(rspn.get('id')))
-    logging.warning("-- New Code Event Headers: {}".format(rspn.get("headers")))
-    logging.warning("-- New Code Change {} Event".format(rspn.get("headers").get("X-Github-Event")))
+    CONNECTION_LOGGER.info("--- SSL connection present: %s", proton.SSL.present())
+    CONNECTION_LOGGER.info("--- RH Variables: rh_cert:%s  rh_key:%s rh_crt:%s amqp_url:%s amqp_topic:%s",
+                           rh_cert, rh_key, rh_crt, amqp_url, topic+amqp_topic)
+
+    loop = asyncio.get_event_loop()
+
+    def sendMessage(payload):
+        amqp_props = dict()
+        amqp_props['subject'] = payload['payload']['head_commit']['message']
+        amqp_message = str(payload)  # "Test Message"
+        producer = AMQProducer(
+            urls=amqp_url,
+            certificate=rh_crt,
+            private_key=rh_key,
+            trusted_certificates=rh_cert,
+            topic=topic+amqp_topic
+        )
+        # send AMQP message to Red Hat UMB service
+        producer.send_msg(amqp_props,amqp_message.encode("utf-8"))
+        TRIGGER_LOGGER.info('-- Sent UMB message to %s', topic+amqp_topic)
+
+    async def trigger(payload):
+        # the AMQP producer blocks, so it runs on a thread of the default executor
+        await loop.run_in_executor(None, sendMessage, payload)
+
+    # dispatcher and coalescer outlive websocket connections, queued messages are sent while reconnecting
+    dispatcher = Dispatcher(dispatch_workers, dispatch_queue_size, trigger, dispatch_stats_interval)
+    coalescer = Coalescer(trigger_window, dispatcher.submit, trigger_dedup_ttl)
+    # events after the last received one are resent by server on reconnect
+    last_event_id = readLastEventId(event_id_file)
+    attempt = 0
+
+    while True:
+        opened = None
+        try:
+            # Opening WebSocket Connection to WebSocket server, pings detect a server gone without closing
+            async with websockets.connect(ws_endpoint, subprotocols=SUBPROTOCOLS, ping_interval=ping_interval or None,
+                                          ping_timeout=ping_timeout or None) as websocket:
+                CONNECTION_LOGGER.info('--- Opened Connection to Server %s ---', ws_endpoint)
+                # backoff is reset by the first frame or a stable connection, not by the handshake, so a server
+                # closing right after accepting is not reconnected to every second
+                opened = time.monotonic()
+                # decoder of frames in negotiated subprotocol, json when server did not select one
+                decode = DECODERS.get(websocket.subprotocol, DECODERS['tightbeam.v1+json'])
+                # subscribing to events for watched repositories, branches and event types
+                await websocket.send(json.dumps(subscription(repositories, matcher.refs() or [], events, fields, alowed, expression)))
+                # asking server for events sent while this client was disconnected
+                if last_event_id:
+                    await websocket.send(json.dumps({'type': 'resume', 'last_event_id': last_event_id}))
+
+                while True:
+                    # Listening for recived messages from websocket server
+                    response = await websocket.recv()
+                    # Connection from websocket server is closed so terminate this iterations
+                    if response is None: break
+                    attempt = 0
+                    envelope = None
+                    try:
+                        envelope = decode(response)
+                        logRecivedMessage(envelope) # Log websocket recived message
+                        last_event_id = envelope.id or last_event_id
+                        writeLastEventId(event_id_file, envelope.id)
+                        # REF Github branch or tag for building project
+                        ref = envelope.ref
+                        if matcher.match(ref):
+                            # webhook payload is decoded only for events sent to UMB
+                            payload = {}
+                            payload["payload"] = envelope.payload
+                            logRecivedMessagePayload(payload["payload"]) # log websocket message payload from webhook
+                            # Create Dictionary of allowed headers from rerouted webhook POST request
+                            payload['headers'] =  {x:y for x,y in envelope.headers.items() if x in alowed}
+                            # Pushes to the same branch within trigger_window send only one message
+                            coalescer.submit((envelope.repository, ref), headCommit(payload["payload"]), payload)
+                        else:
+                            logDifferentBranchName(ref,branch_name)
+                    except Exception:
+                        # a frame that cannot be decoded or handled is skipped, the connection stays up
+                        EVENT_LOGGER.exception('-- Skipped event %s which could not be handled', envelope and envelope.id)
+        except CONNECTION_ERRORS as e:
+            if closeCode(e) == 1008:
+                # server rejected the subscription, reconnecting with the same settings does not help
+                CONNECTION_LOGGER.error('--- Server %s refused subscription: %s ---', ws_endpoint, repr(e))
+                raise
+            if opened is not None and time.monotonic() - opened >= reconnect_max_delay:
+                attempt = 0
+            # Waiting before reconnecting, so a restarted server is not hit by all clients at once
+            delay = reconnectDelay(attempt, reconnect_delay, reconnect_max_delay)
+            attempt += 1
+            CONNECTION_LOGGER.warning('--- Connection to Server %s lost: %s, reconnecting in %.1fs ---',
+                                      ws_endpoint, repr(e), delay)
+            await asyncio.sleep(delay)
+
+
+def subscription(repositories, refs, events, fields, headers, expression=''):
+    # Server sends only events matching every non-empty list and the filter of this message,
+    # with only the projected payload fields and headers
+    return {
+        'type': 'subscribe',
+        'repositories': [x.strip() for x in repositories.split(',') if x.strip()],
+        'refs': refs,
+        'events': [x.strip() for x in events.split(',') if x.strip()],
+        'filter': expression or None,
+        'projection': {
+            'fields': [x.strip() for x in fields.split(',') if x.strip()],
+            'headers': headers
+        }
+    }
+
+def reconnectDelay(attempt, base, maximum):
+    # exponential backoff with jitter of up to half the delay
+    delay = min(maximum, base * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+def closeCode(error):
+    # close code server sent with a closed connection, None for other errors
+    if not isinstance(error, websockets.ConnectionClosed):
+        return None
+    if hasattr(error, 'rcvd'):
+        # websockets 10 and later
+        return error.rcvd.code if error.rcvd is not None else None
+    return error.code
+
+def readLastEventId(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return f.read().strip()
+    return None
+
+def writeLastEventId(path, event_id):
+    if path and event_id:
+        with open(path, 'w') as f:
+            f.write(event_id)
+
+def repositoryName(payload):
+    return (payload.get('repository') or {}).get('full_name')
+
+def headCommit(payload):
+    # sha the ref points to after the event, push events carry it as "after" and in head_commit
+    return payload.get('after') or (payload.get('head_commit') or {}).get('id')
+
+def logRecivedMessage(envelope):
+    EVENT_LOGGER.info("-- New Code Change Event: %s", logs.Fields(id=envelope.id, event=envelope.event, ref=envelope.ref))
+    EVENT_LOGGER.debug("-- New Code Event Headers: %s", envelope.headers)
 
 def logRecivedMessagePayload(payload):
-    logging.warning(payload.get('ref'))
-    logging.warning(payload.get('pusher'))
+    EVENT_LOGGER.info("-- New Code Change: %s", logs.Fields(ref=payload.get('ref'), pusher=payload.get('pusher')))
 
 async def logResponseMessage(resp,url):
-    logging.warning('-- Sending HTTP POST to {}'.format(url))
-    logging.warning(resp.status)
-    logging.warning(resp.text())
+    TRIGGER_LOGGER.info('-- Sent HTTP POST to %s: %s', url, resp.status)
+    if TRIGGER_LOGGER.isEnabledFor(logging.DEBUG):
+        TRIGGER_LOGGER.debug('%s', await resp.text())
 
-def logGetResponseMessage(resp,url):
-    logging.warning('-- Sending HTTP GET to {}'.format(url))
-    logging.warning(resp.status)
-    logging.warning(resp.text())
+async def logGetResponseMessage(resp,url):
+    TRIGGER_LOGGER.info('-- Sent HTTP GET to %s: %s', url, resp.status)
+    if TRIGGER_LOGGER.isEnabledFor(logging.DEBUG):
+        TRIGGER_LOGGER.debug('%s', await resp.text())
 
 def logDifferentBranchName(ref,branch):
-    logging.warning('This Repository branch name: {} is not equal to projects branch: {}'.format(ref, branch))
+    EVENT_LOGGER.info('This Repository ref: %s does not match projects branches: %s', ref, branch)
 
 # Start Non-Blocking thread for Asynchronous Handling of Long Lived Connections
-asyncio.get_event_loop().run_until_complete(start())
+if __name__ == '__main__':
+    logs.setup()
+    asyncio.get_event_loop().run_until_complete(start())
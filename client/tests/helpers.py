@@ -0,0 +1,14 @@
+import importlib.util
+import os
+import sys
+
+CLIENT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def load_client():
+    # client.async.py is not an importable module name, it is loaded from its path
+    sys.path.insert(0, CLIENT_DIR)
+    spec = importlib.util.spec_from_file_location('client_async', os.path.join(CLIENT_DIR, 'client.async.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
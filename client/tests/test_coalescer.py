@@ -0,0 +1,87 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers import load_client
+
+client = load_client()
+
+
+class TestCoalescer(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.sent = []
+        self.results = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    def send(self, key, *args, done):
+        self.sent.append(args)
+        self.results.append(done)
+
+    def run_for(self, seconds):
+        self.loop.run_until_complete(asyncio.sleep(seconds))
+
+    def test_window_sends_latest_head_once(self):
+        coalescer = client.Coalescer(0.05, self.send)
+        for head in ('a', 'b', 'c'):
+            coalescer.submit(('o/r', 'main'), head, head)
+        coalescer.submit(('o/r', 'dev'), 'x', 'x')
+        self.run_for(0.1)
+        self.assertEqual(sorted(self.sent), [('c',), ('x',)])
+        self.assertEqual(coalescer.stats()['coalesced'], 2)
+
+    def test_sent_head_is_duplicate(self):
+        coalescer = client.Coalescer(0.01, self.send)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.05)
+        self.results[0](True)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.05)
+        self.assertEqual(self.sent, [('a',)])
+        self.assertEqual(coalescer.duplicates, 1)
+
+    def test_branch_moved_back_to_sent_head(self):
+        coalescer = client.Coalescer(0.05, self.send)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.1)
+        self.results[0](True)
+        # force-pushed to b and back to a within the window, neither is built
+        coalescer.submit(('o/r', 'main'), 'b', 'b')
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.1)
+        self.assertEqual(self.sent, [('a',)])
+        # moved to b and stays there, b is built
+        coalescer.submit(('o/r', 'main'), 'b', 'b')
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        coalescer.submit(('o/r', 'main'), 'b', 'b')
+        self.run_for(0.1)
+        self.assertEqual(self.sent, [('a',), ('b',)])
+        self.assertEqual(coalescer.stats()['saved'], coalescer.received - coalescer.sent)
+
+    def test_failed_head_triggered_again(self):
+        coalescer = client.Coalescer(0.01, self.send)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.05)
+        self.results[0](False)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.05)
+        self.assertEqual(self.sent, [('a',), ('a',)])
+
+    def test_head_forgotten_after_ttl(self):
+        coalescer = client.Coalescer(0.01, self.send, ttl=0.05)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.1)
+        coalescer.submit(('o/r', 'main'), 'a', 'a')
+        self.run_for(0.05)
+        self.assertEqual(self.sent, [('a',), ('a',)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers import load_client
+
+client = load_client()
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.sent = []
+
+    def tearDown(self):
+        for task in asyncio.all_tasks(self.loop):
+            task.cancel()
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.loop.close()
+
+    async def send(self, value):
+        if value == 'fail':
+            raise RuntimeError(value)
+        self.sent.append(value)
+
+    def dispatch(self, workers, max_queued, submits):
+        async def run():
+            dispatcher = client.Dispatcher(workers, max_queued, self.send)
+            for key, value in submits:
+                dispatcher.submit(key, value)
+            await asyncio.sleep(0.05)
+            return dispatcher
+        return self.loop.run_until_complete(run())
+
+    def test_queue_sent_in_order(self):
+        dispatcher = self.dispatch(1, 20, [('a', 1), ('b', 2), ('c', 3)])
+        self.assertEqual(self.sent, [1, 2, 3])
+        self.assertEqual(dispatcher.stats()['dispatched'], 3)
+
+    def test_queued_trigger_replaced_by_same_key(self):
+        dispatcher = self.dispatch(1, 2, [('a', 1), ('a', 2), ('b', 3)])
+        self.assertEqual(self.sent, [2, 3])
+        self.assertEqual(dispatcher.superseded, 1)
+        self.assertEqual(dispatcher.dropped, 0)
+
+    def test_full_queue_drops_new_key_only(self):
+        dispatcher = self.dispatch(1, 2, [('a', 1), ('b', 2), ('c', 3), ('b', 4)])
+        self.assertEqual(self.sent, [1, 4])
+        self.assertEqual(dispatcher.dropped, 1)
+
+    def test_done_tells_whether_sent(self):
+        results = []
+
+        async def run():
+            dispatcher = client.Dispatcher(1, 2, self.send)
+            for key, value in (('a', 'fail'), ('b', 1), ('c', 2)):
+                dispatcher.submit(key, value, done=lambda sent, value=value: results.append((value, sent)))
+            await asyncio.sleep(0.05)
+        self.loop.run_until_complete(run())
+        self.assertEqual(sorted(results, key=str), [('fail', False), (1, True), (2, False)])
+
+    def test_failures_counted(self):
+        dispatcher = self.dispatch(1, 10, [('a', 'fail'), ('b', 1)])
+        self.assertEqual(self.sent, [1])
+        self.assertEqual((dispatcher.failed, dispatcher.dispatched), (1, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers import load_client
+
+client = load_client()
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'server'))
+
+from server import Event
+
+HEADERS = {'X-Github-Event': 'push', 'Content-Type': 'application/json', 'X-Github-Delivery': 'd1'}
+PAYLOAD = {'ref': 'refs/heads/main', 'repository': {'full_name': 'org/app'}, 'pusher': {'name': 'alice'},
+           'head_commit': {'id': 'abc', 'message': 'say "payload": here'}}
+
+
+class TestJsonFrames(unittest.TestCase):
+    # decodeJsonFrame relies on the layout of the v2 frames the server encodes
+
+    def decode(self, projection=None):
+        event = Event(HEADERS, json.dumps(PAYLOAD).encode('utf-8'))
+        return event, client.decodeJsonFrame(event.frame('v2', projection).decode('utf-8'))
+
+    def assertSplit(self, envelope, event):
+        # the envelope is decoded without the payload, which is left for later
+        self.assertIsNotNone(envelope.raw)
+        self.assertIsNone(envelope._payload)
+        self.assertEqual(envelope.id, event.id)
+        self.assertEqual(envelope.repository, 'org/app')
+        self.assertEqual(envelope.ref, 'refs/heads/main')
+        self.assertEqual(envelope.event, 'push')
+
+    def test_whole_payload(self):
+        event, envelope = self.decode()
+        self.assertSplit(envelope, event)
+        self.assertEqual(envelope.payload, PAYLOAD)
+        self.assertEqual(envelope.headers, HEADERS)
+
+    def test_projected_payload(self):
+        event, envelope = self.decode((('ref', 'head_commit.message'), ('x-github-event',)))
+        self.assertSplit(envelope, event)
+        self.assertEqual(envelope.payload, {'ref': 'refs/heads/main', 'head_commit': {'message': 'say "payload": here'}})
+        self.assertEqual(envelope.headers, {'X-Github-Event': 'push'})
+
+    def test_projected_headers(self):
+        event, envelope = self.decode(((), ('x-github-event',)))
+        self.assertSplit(envelope, event)
+        self.assertEqual(envelope.raw, json.dumps(PAYLOAD))
+
+    def test_v1_frame(self):
+        event = Event(HEADERS, json.dumps(PAYLOAD).encode('utf-8'))
+        envelope = client.DECODERS['tightbeam.v1+json'](event.frame('v1').decode('utf-8'))
+        self.assertEqual((envelope.id, envelope.repository, envelope.payload), (event.id, 'org/app', PAYLOAD))
+
+
+if __name__ == '__main__':
+    unittest.main()
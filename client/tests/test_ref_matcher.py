@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers import load_client
+
+client = load_client()
+
+
+class FakeTarget(object):
+
+    def __init__(self, refs):
+        self.matcher = client.RefMatcher(refs)
+
+
+class TestRefMatcher(unittest.TestCase):
+
+    def test_exact_branches(self):
+        matcher = client.RefMatcher('main, feature/foo')
+        self.assertTrue(matcher.match('refs/heads/main'))
+        self.assertTrue(matcher.match('refs/heads/feature/foo'))
+        self.assertFalse(matcher.match('refs/heads/feature/foobar'))
+        self.assertFalse(matcher.match('refs/tags/main'))
+        self.assertEqual(matcher.refs(), ['refs/heads/feature/foo', 'refs/heads/main'])
+
+    def test_globs(self):
+        matcher = client.RefMatcher('release/*,refs/tags/v1.*,hotfix-?')
+        self.assertTrue(matcher.match('refs/heads/release/2.0'))
+        self.assertTrue(matcher.match('refs/tags/v1.4'))
+        self.assertTrue(matcher.match('refs/heads/hotfix-1'))
+        self.assertFalse(matcher.match('refs/heads/hotfix-12'))
+        self.assertFalse(matcher.match('refs/tags/v2.0'))
+        self.assertFalse(matcher.match('refs/heads/main'))
+        self.assertIsNone(matcher.refs())
+
+    def test_empty(self):
+        matcher = client.RefMatcher(' , ')
+        self.assertFalse(matcher.match('refs/heads/main'))
+        self.assertFalse(client.RefMatcher('main').match(None))
+        self.assertFalse(client.RefMatcher('main').match(''))
+        self.assertEqual(matcher.refs(), [])
+
+    def test_subscribed_refs(self):
+        self.assertEqual(client.subscribedRefs([FakeTarget('main'), FakeTarget('dev,main'), FakeTarget('')]),
+                         ['refs/heads/dev', 'refs/heads/main'])
+        # server only matches exact refs, a target with globs needs all of them
+        self.assertEqual(client.subscribedRefs([FakeTarget('main'), FakeTarget('release/*')]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,349 @@
+import argparse
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.locks
+import tornado.websocket
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Load and latency benchmark of server.py: starts a server, connects websocket clients, posts
+# synthetic github push webhooks and reports throughput, delivery latency percentiles and
+# server cpu and memory. Thresholds and a baseline result turn it into a regression gate:
+#
+#   python bench.py --events 5000 --clients 50 --save baseline.json
+#   python bench.py --events 5000 --clients 50 --baseline baseline.json --tolerance 0.2 --max-p99-ms 50
+#
+# The exit code is 1 when a threshold is not met, 2 when not every event was delivered.
+
+LOGGER = logging.getLogger('tightbeam.bench')
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def arguments():
+    parser = argparse.ArgumentParser(description='tightbeam server benchmark')
+    parser.add_argument('--events', type=int, default=2000, help='webhooks to post')
+    parser.add_argument('--clients', type=int, default=20, help='websocket clients receiving every webhook')
+    parser.add_argument('--concurrency', type=int, default=16, help='webhook requests in flight')
+    parser.add_argument('--rate', type=float, default=0, help='webhooks per second, 0 for as fast as possible')
+    parser.add_argument('--repositories', type=int, default=10, help='repositories the webhooks are spread over')
+    parser.add_argument('--median-bytes', type=int, default=8192, help='median webhook body size')
+    parser.add_argument('--max-bytes', type=int, default=1024 * 1024, help='largest webhook body size')
+    parser.add_argument('--subprotocol', default='tightbeam.v2+json', help='websocket subprotocol of the clients')
+    parser.add_argument('--compression', dest='compression', action='store_true', default=True,
+                        help='clients offer permessage-deflate like production clients do ( default )')
+    parser.add_argument('--no-compression', dest='compression', action='store_false',
+                        help='clients do not offer permessage-deflate')
+    parser.add_argument('--fields', default='bench,ref,head_commit,pusher,repository.full_name',
+                        help='payload fields clients subscribe to, empty for whole payloads')
+    parser.add_argument('--port', type=int, default=18182)
+    parser.add_argument('--workers', type=int, default=1, help='WORKERS of the server')
+    parser.add_argument('--server-env', action='append', default=[], metavar='NAME=VALUE',
+                        help='extra environment variable of the server')
+    parser.add_argument('--url', help='benchmark an already running server at this url instead of starting one')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for every delivery')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save', help='write the result to this json file')
+    parser.add_argument('--baseline', help='result json file to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed regression against the baseline')
+    parser.add_argument('--min-throughput', type=float, help='minimum delivered webhooks per second')
+    parser.add_argument('--max-p99-ms', type=float, help='maximum p99 delivery latency')
+    parser.add_argument('--max-p999-ms', type=float, help='maximum p99.9 delivery latency')
+    parser.add_argument('--max-cpu-ms-per-event', type=float, help='maximum server cpu time per webhook')
+    parser.add_argument('--max-rss-mb', type=float, help='maximum server resident memory')
+    return parser.parse_args()
+
+
+def payload_sizes(count, median, largest, rng):
+    # Push payload sizes are roughly log-normal: most carry a commit or two, a few carry many
+    return [int(min(largest, max(1024, rng.lognormvariate(math.log(median), 1.0)))) for _ in range(count)]
+
+
+def push_body(size, repository, rng):
+    # json of a github push webhook of about size bytes, without its leading "{" so the
+    # benchmark fields can be put in front of it when it is sent
+    sha = '{:040x}'.format(rng.getrandbits(160))
+    author = {'name': 'Bench User', 'email': 'bench@example.com', 'username': 'bench'}
+    commit = {
+        'id': sha, 'tree_id': sha, 'distinct': True, 'message': 'Benchmark commit',
+        'timestamp': '2019-01-01T00:00:00Z', 'url': 'https://github.com/{}/commit/{}'.format(repository, sha),
+        'author': author, 'committer': author, 'added': [], 'removed': [], 'modified': ['README.md']
+    }
+    payload = {
+        'ref': 'refs/heads/main', 'before': '0' * 40, 'after': sha, 'created': False, 'deleted': False,
+        'forced': False, 'compare': 'https://github.com/{}/compare'.format(repository),
+        'repository': {'full_name': repository, 'name': repository.split('/')[1], 'private': False},
+        'pusher': {'name': 'bench', 'email': 'bench@example.com'}, 'sender': {'login': 'bench'},
+        'head_commit': commit, 'commits': [commit]
+    }
+    body = json.dumps(payload)
+    while len(body) < size:
+        # further commits, each with a message filling part of the remaining size
+        extra = dict(commit, id='{:040x}'.format(rng.getrandbits(160)),
+                     message='x' * min(4096, max(16, size - len(body) - 600)))
+        payload['commits'].append(extra)
+        body = json.dumps(payload)
+    return body[1:].encode('utf-8')
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, int(math.ceil(q * len(values))) - 1))]
+
+
+class ServerProcess(object):
+    # server.py started for the benchmark, with cpu and memory read from /proc
+
+    def __init__(self, args):
+        # event log and worker sockets of this run, removed when it stops
+        self.directories = {
+            'EVENT_LOG_DIR': tempfile.mkdtemp(prefix='tightbeam-bench-'),
+            'WORKERS_SOCKET_DIR': tempfile.mkdtemp(prefix='tightbeam-bench-workers-')
+        }
+        env = dict(os.environ, PORT=str(args.port), WORKERS=str(args.workers), LOG_LEVEL='WARNING',
+                   INGEST_REPO_RATE='0', INGEST_QUEUE_SIZE=str(max(1000, args.events)), **self.directories)
+        env.update(x.split('=', 1) for x in args.server_env)
+        self.process = subprocess.Popen([sys.executable, os.path.join(HERE, 'server.py')], cwd=HERE, env=env,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def pids(self):
+        # the server and its forked workers
+        pids = [self.process.pid]
+        try:
+            with open('/proc/{}/task/{}/children'.format(self.process.pid, self.process.pid)) as f:
+                pids += [int(x) for x in f.read().split()]
+        except OSError:
+            pass
+        return pids
+
+    def cpu_seconds(self):
+        total = 0.0
+        for pid in self.pids():
+            try:
+                with open('/proc/{}/stat'.format(pid)) as f:
+                    fields = f.read().rsplit(')', 1)[1].split()
+                total += (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            except (OSError, IndexError):
+                pass
+        return total
+
+    def rss_bytes(self):
+        total = 0
+        for pid in self.pids():
+            try:
+                with open('/proc/{}/status'.format(pid)) as f:
+                    total += next(int(x.split()[1]) * 1024 for x in f if x.startswith('VmRSS:'))
+            except (OSError, StopIteration):
+                pass
+        return total
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+        for directory in self.directories.values():
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class Client(object):
+    # websocket client recording the delivery latency of every benchmark webhook it receives
+
+    def __init__(self, url, args):
+        self.url = url
+        self.args = args
+        self.latencies = []
+        self.received = 0
+
+    async def connect(self):
+        request = tornado.httpclient.HTTPRequest(self.url, headers={'Origin': 'https://bench.redhat.com'})
+        self.connection = await tornado.websocket.websocket_connect(
+            request, subprotocols=[self.args.subprotocol], compression_options={} if self.args.compression else None)
+        fields = [x for x in self.args.fields.split(',') if x]
+        await self.connection.write_message(json.dumps({
+            'type': 'subscribe', 'projection': {'fields': fields, 'headers': ['X-Github-Event']} if fields else None
+        }))
+
+    def decode(self, message):
+        if self.args.subprotocol.endswith('+msgpack'):
+            return msgpack.unpackb(message, raw=False)
+        if self.args.subprotocol.endswith('+cbor'):
+            return cbor2.loads(message)
+        return json.loads(message)
+
+    async def run(self):
+        while True:
+            message = await self.connection.read_message()
+            if message is None:
+                break
+            received = time.time()
+            payload = self.decode(message)['payload']
+            if isinstance(payload, str):
+                payload = json.loads(payload)
+            bench = payload.get('bench')
+            if bench:
+                self.latencies.append(received - bench['sent'])
+                self.received += 1
+
+
+async def post_webhooks(url, bodies, repositories, args):
+    http = tornado.httpclient.AsyncHTTPClient(max_clients=args.concurrency)
+    # response status -> count, 599 for connection errors
+    statuses = {}
+    interval = 1.0 / args.rate if args.rate > 0 else 0
+    slots = tornado.locks.Semaphore(args.concurrency)
+
+    async def send(request):
+        try:
+            code = (await http.fetch(request, raise_error=False)).code
+        except Exception:
+            code = 599
+        finally:
+            slots.release()
+        statuses[code] = statuses.get(code, 0) + 1
+
+    start = time.time()
+    requests = []
+    for seq, (body, repository) in enumerate(zip(bodies, repositories)):
+        if interval:
+            await tornado.gen.sleep(max(0, start + seq * interval - time.time()))
+        await slots.acquire()
+        prefix = '{{"bench": {{"seq": {}, "sent": {:.6f}}}, '.format(seq, time.time()).encode('utf-8')
+        request = tornado.httpclient.HTTPRequest(url, method='POST', body=prefix + body, headers={
+            'Content-Type': 'application/json', 'X-Github-Event': 'push', 'X-Github-Delivery': str(uuid.uuid4())
+        })
+        # started right away, the slot is given back when the response arrives
+        requests.append(tornado.gen.convert_yielded(send(request)))
+    await tornado.gen.multi(requests)
+    return statuses, time.time() - start
+
+
+async def benchmark(args):
+    rng = random.Random(args.seed)
+    base = args.url or 'http://127.0.0.1:{}'.format(args.port)
+    server = None if args.url else ServerProcess(args)
+    try:
+        stats_url = base.rstrip('/') + '/stats'
+        for _ in range(100):
+            try:
+                await tornado.httpclient.AsyncHTTPClient().fetch(stats_url)
+                break
+            except (OSError, tornado.httpclient.HTTPClientError):
+                await tornado.gen.sleep(0.1)
+        names = ['bench/repository-{}'.format(x) for x in range(args.repositories)]
+        repositories = [names[x % len(names)] for x in range(args.events)]
+        sizes = payload_sizes(args.events, args.median_bytes, args.max_bytes, rng)
+        bodies = [push_body(size, repository, rng) for size, repository in zip(sizes, repositories)]
+
+        clients = [Client(base.replace('http', 'ws', 1).rstrip('/') + '/ws', args) for _ in range(args.clients)]
+        for client in clients:
+            await client.connect()
+            tornado.ioloop.IOLoop.current().spawn_callback(client.run)
+        await tornado.gen.sleep(0.5)
+
+        cpu_before = server.cpu_seconds() if server else None
+        start = time.time()
+        statuses, post_seconds = await post_webhooks(base.rstrip('/') + '/', bodies, repositories, args)
+        expected = statuses.get(202, 0)
+        deadline = time.time() + args.timeout
+        while time.time() < deadline and any(client.received < expected for client in clients):
+            await tornado.gen.sleep(0.05)
+        elapsed = time.time() - start
+        latencies = sorted(x for client in clients for x in client.latencies)
+        delivered = min(client.received for client in clients) if clients else expected
+        result = {
+            'events': args.events,
+            'clients': args.clients,
+            'compression': args.compression,
+            'accepted': expected,
+            'statuses': {str(x): y for x, y in statuses.items()},
+            'delivered_to_every_client': delivered,
+            'median_body_bytes': sorted(sizes)[len(sizes) // 2] if sizes else 0,
+            'ingest_per_second': round(args.events / post_seconds, 1) if post_seconds else None,
+            'throughput_per_second': round(delivered / elapsed, 1) if elapsed else None,
+            'deliveries_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'latency_ms': {
+                name: round(percentile(latencies, q) * 1000, 3) if latencies else None
+                for name, q in (('p50', 0.5), ('p99', 0.99), ('p999', 0.999), ('max', 1.0))
+            }
+        }
+        if server:
+            cpu = server.cpu_seconds() - cpu_before
+            result['server_cpu_seconds'] = round(cpu, 3)
+            result['server_cpu_ms_per_event'] = round(cpu * 1000 / max(1, expected), 4)
+            result['server_rss_mb'] = round(server.rss_bytes() / 1024.0 / 1024.0, 1)
+        return result
+    finally:
+        if server:
+            server.stop()
+
+
+def regressions(result, args):
+    # Failed thresholds and baseline comparisons
+    failures = []
+    latency = result['latency_ms']
+
+    def check(name, value, limit, higher_is_worse=True):
+        if limit is None or value is None:
+            return
+        if (value > limit) if higher_is_worse else (value < limit):
+            failures.append('{} {} over limit {}'.format(name, value, limit) if higher_is_worse
+                            else '{} {} under limit {}'.format(name, value, limit))
+
+    check('throughput_per_second', result['throughput_per_second'], args.min_throughput, higher_is_worse=False)
+    check('p99_ms', latency['p99'], args.max_p99_ms)
+    check('p999_ms', latency['p999'], args.max_p999_ms)
+    check('server_cpu_ms_per_event', result.get('server_cpu_ms_per_event'), args.max_cpu_ms_per_event)
+    check('server_rss_mb', result.get('server_rss_mb'), args.max_rss_mb)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        more, less = 1 + args.tolerance, 1 - args.tolerance
+        check('throughput_per_second', result['throughput_per_second'],
+              baseline['throughput_per_second'] * less if baseline.get('throughput_per_second') else None,
+              higher_is_worse=False)
+        for name in ('p50', 'p99'):
+            base = baseline['latency_ms'].get(name)
+            check(name + '_ms', latency[name], base * more if base else None)
+        for name in ('server_cpu_ms_per_event', 'server_rss_mb'):
+            check(name, result.get(name), baseline[name] * more if baseline.get(name) else None)
+    return failures
+
+
+def main():
+    logging.basicConfig(format='%(levelname)s %(message)s')
+    args = arguments()
+    result = tornado.ioloop.IOLoop.current().run_sync(lambda: benchmark(args))
+    print(json.dumps(result, indent=2))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if result['delivered_to_every_client'] < result['accepted'] or result['accepted'] < args.events:
+        LOGGER.error('--- Not every webhook was accepted and delivered to every client')
+        return 2
+    failures = regressions(result, args)
+    for failure in failures:
+        LOGGER.error('--- Regression: %s', failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
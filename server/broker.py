@@ -0,0 +1,95 @@
+import collections
+import logging
+import os
+import uuid
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+import logs
+from fanout import PUBLISH, SUBSCRIBE, RELAY, pack, parse_address, read_message
+
+# Address the broker listens on, "host:port" or a unix socket path
+FANOUT_BROKER_LISTEN = os.getenv('FANOUT_BROKER_LISTEN', '0.0.0.0:8183')
+# Relayed events kept to catch up replicas that reconnect
+FANOUT_BROKER_BACKLOG = int(os.getenv('FANOUT_BROKER_BACKLOG', '10000'))
+# Bytes waiting for one replica before it is disconnected, it catches up from the backlog
+FANOUT_BROKER_MAX_BUFFER = int(os.getenv('FANOUT_BROKER_MAX_BUFFER', str(64 * 1024 * 1024)))
+
+LOGGER = logging.getLogger('tightbeam.broker')
+
+
+class Broker(tornado.tcpserver.TCPServer):
+    # Pub-sub stand-in between server replicas, see BrokerFanout in fanout.py. Every event
+    # a replica publishes is numbered and relayed to all subscribed replicas in one order.
+    # A restarted broker starts a new epoch, replicas from an older one get the whole backlog.
+
+    def __init__(self, backlog, max_buffer):
+        super(Broker, self).__init__()
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        self.max_buffer = max_buffer
+        # (sequence number, relayed message)
+        self.backlog = collections.deque(maxlen=backlog)
+        self.streams = set()
+        self.relayed = 0
+        self.disconnected = 0
+
+    async def handle_stream(self, stream, address):
+        stream.max_write_buffer_size = self.max_buffer
+        try:
+            while True:
+                kind, meta, body = await read_message(stream)
+                if kind == SUBSCRIBE:
+                    self.subscribe(stream, meta)
+                elif kind == PUBLISH:
+                    self.relay(meta, body)
+        except tornado.iostream.StreamClosedError:
+            pass
+        finally:
+            self.streams.discard(stream)
+
+    def subscribe(self, stream, meta):
+        # New replicas only get new events, reconnecting ones what they missed
+        if meta.get('epoch') == self.epoch:
+            missed = [message for seq, message in self.backlog if seq > meta.get('after', -1)]
+        elif meta.get('epoch') is not None:
+            missed = [message for seq, message in self.backlog]
+        else:
+            missed = []
+        self.streams.add(stream)
+        for message in missed:
+            self.write(stream, message)
+        LOGGER.info('--- Replica subscribed, %s events resent', len(missed))
+
+    def relay(self, meta, body):
+        meta['relay'] = [self.epoch, self.seq]
+        message = pack(RELAY, meta, body)
+        self.backlog.append((self.seq, message))
+        self.seq += 1
+        self.relayed += 1
+        for stream in list(self.streams):
+            self.write(stream, message)
+
+    def write(self, stream, message):
+        try:
+            stream.write(message)
+        except tornado.iostream.StreamBufferFullError:
+            LOGGER.warning('--- Replica over %s buffered bytes disconnected', self.max_buffer)
+            self.disconnected += 1
+            self.streams.discard(stream)
+            stream.close()
+        except tornado.iostream.StreamClosedError:
+            self.streams.discard(stream)
+
+
+if __name__ == '__main__':
+    logs.setup()
+    broker = Broker(FANOUT_BROKER_BACKLOG, FANOUT_BROKER_MAX_BUFFER)
+    address = parse_address(FANOUT_BROKER_LISTEN)
+    if isinstance(address, tuple):
+        broker.add_sockets(tornado.netutil.bind_sockets(address[1], address=address[0]))
+    else:
+        broker.add_socket(tornado.netutil.bind_unix_socket(address))
+    LOGGER.info('--- Fan-out broker listening on %s', FANOUT_BROKER_LISTEN)
+    tornado.ioloop.IOLoop.current().start()
@@ -0,0 +1,209 @@
+import collections
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+
+LOGGER = logging.getLogger('tightbeam.eventlog')
+
+# Record header: length of the metadata, length of the data
+HEADER = struct.Struct('>II')
+
+
+class Segment(object):
+    # One preallocated, memory-mapped log file holding records starting at sequence number `first`
+
+    def __init__(self, path, first, size=None):
+        self.path = path
+        self.first = first
+        self.ids = []
+        self.position = 0
+        self.mtime = time.time()
+        if size is not None:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+        self.file = open(path, 'r+b')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.map = mmap.mmap(self.file.fileno(), self.size)
+        self.closed = False
+
+    def fits(self, length):
+        return self.position + HEADER.size + length <= self.size
+
+    def append(self, meta, data):
+        start = self.position
+        end = start + HEADER.size + len(meta) + len(data)
+        self.map[start:start + HEADER.size] = HEADER.pack(len(meta), len(data))
+        self.map[start + HEADER.size:start + HEADER.size + len(meta)] = meta
+        self.map[start + HEADER.size + len(meta):end] = data
+        self.position = end
+        self.mtime = time.time()
+        return start
+
+    def read(self, position):
+        # (metadata, data, next position) of the record at position, None at the end
+        if position + HEADER.size > self.position:
+            return None
+        meta_len, data_len = HEADER.unpack_from(self.map, position)
+        start = position + HEADER.size
+        meta = json.loads(self.map[start:start + meta_len].decode('utf-8'))
+        data = self.map[start + meta_len:start + meta_len + data_len]
+        return meta, data, start + meta_len + data_len
+
+    def recover(self):
+        # Walk the records written before a restart, stop at the first empty header. A record torn
+        # by a crash, which cannot be parsed or is out of sequence, ends the segment and is zeroed
+        # together with everything after it, so it is overwritten by new records.
+        position = 0
+        seq = self.first
+        while position + HEADER.size <= self.size:
+            meta_len, data_len = HEADER.unpack_from(self.map, position)
+            if meta_len == 0 and data_len == 0:
+                break
+            end = position + HEADER.size + meta_len + data_len
+            try:
+                if meta_len == 0 or end > self.size:
+                    raise ValueError('record exceeds segment')
+                meta = json.loads(self.map[position + HEADER.size:position + HEADER.size + meta_len].decode('utf-8'))
+                if meta['seq'] != seq or not isinstance(meta['id'], str):
+                    raise ValueError('record out of sequence')
+            except (ValueError, KeyError, TypeError) as e:
+                LOGGER.warning('--- Event log segment %s truncated at torn record %s: %s', self.path, position, e)
+                self.truncate(position)
+                break
+            yield position, meta
+            position = end
+            self.position = end
+            seq += 1
+        self.mtime = os.stat(self.path).st_mtime
+
+    def truncate(self, position):
+        # Zero the segment from position on in bounded chunks
+        chunk = 1 << 20
+        while position < self.size:
+            end = min(self.size, position + chunk)
+            self.map[position:end] = bytes(end - position)
+            position = end
+        self.map.flush()
+
+    def flush(self):
+        if not self.closed:
+            self.map.flush()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.map.flush()
+            self.map.close()
+            self.file.close()
+
+
+class EventLog(object):
+    # Append-only log of broadcast events split into memory-mapped segment files,
+    # old segments are removed once the log is over retention_bytes or older than retention_seconds
+
+    def __init__(self, directory, segment_bytes, retention_bytes, retention_seconds):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        self.segments = collections.deque()
+        # event id -> (segment, position, sequence number)
+        self.index = {}
+        self.next_seq = 0
+        os.makedirs(directory, exist_ok=True)
+        self.recover()
+
+    def recover(self):
+        names = sorted(x for x in os.listdir(self.directory) if x.endswith('.log'))
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if os.path.getsize(path) == 0:
+                # Created but not preallocated before a crash, it holds no records
+                LOGGER.warning('--- Empty event log segment removed: %s', path)
+                os.remove(path)
+                continue
+            segment = Segment(path, int(name[:-4]))
+            for position, meta in segment.recover():
+                self.index[meta['id']] = (segment, position, meta['seq'])
+                segment.ids.append(meta['id'])
+                self.next_seq = meta['seq'] + 1
+            self.segments.append(segment)
+        LOGGER.info('--- Event log %s: %s events in %s segments', self.directory, len(self.index), len(self.segments))
+
+    def append(self, meta, data):
+        # Store data with its metadata dict, which must hold the event "id",
+        # returns the sequence number given to the event
+        seq = self.next_seq
+        event_id = meta['id']
+        meta = json.dumps(dict(meta, seq=seq)).encode('utf-8')
+        length = len(meta) + len(data)
+        if not self.segments or not self.segments[-1].fits(length):
+            self.roll(length)
+        segment = self.segments[-1]
+        position = segment.append(meta, data)
+        segment.ids.append(event_id)
+        self.index[event_id] = (segment, position, seq)
+        self.next_seq = seq + 1
+        return seq
+
+    def roll(self, length):
+        if self.segments:
+            self.segments[-1].flush()
+        path = os.path.join(self.directory, '{:020d}.log'.format(self.next_seq))
+        size = max(self.segment_bytes, HEADER.size * 2 + length)
+        self.segments.append(Segment(path, self.next_seq, size))
+        self.retain()
+
+    def retain(self):
+        now = time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            total = sum(segment.size for segment in self.segments)
+            if total <= self.retention_bytes and now - oldest.mtime <= self.retention_seconds:
+                break
+            self.segments.popleft()
+            for event_id in oldest.ids:
+                self.index.pop(event_id, None)
+            oldest.close()
+            os.remove(oldest.path)
+            LOGGER.info('--- Event log segment removed: %s', oldest.path)
+
+    def read_after(self, event_id):
+        # Yield (metadata, data) of every event logged after event_id,
+        # from the oldest retained event when event_id is unknown or expired.
+        # New events appended while iterating are yielded as well.
+        if event_id in self.index:
+            segment, position, seq = self.index[event_id]
+            record = segment.read(position)
+            position = record[2] if record else position
+        else:
+            segment, position, seq = None, 0, -1
+        while True:
+            if segment is None or segment.closed:
+                segment = next((x for x in self.segments if x.first > seq), None)
+                position = 0
+                if segment is None:
+                    return
+            record = segment.read(position)
+            if record is None:
+                later = [x for x in self.segments if x.first > segment.first]
+                if not later:
+                    return
+                segment, position = later[0], 0
+                continue
+            meta, data, position = record
+            seq = meta['seq']
+            yield meta, data
+
+    def flush(self):
+        # Called periodically, so segments also age out while no events arrive
+        if self.segments:
+            self.segments[-1].flush()
+        self.retain()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
@@ -0,0 +1,291 @@
+import collections
+import json
+import logging
+import os
+import socket
+import struct
+import zlib
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.locks
+import tornado.netutil
+import tornado.tcpclient
+import tornado.tcpserver
+
+LOGGER = logging.getLogger('tightbeam.fanout')
+
+# Message header: kind, length of the metadata, length of the body
+HEADER = struct.Struct('>BII')
+# Event sent to the worker ordering its repository
+FORWARD = 1
+# Ordered event to broadcast to the sessions of the receiving worker, or event a replica sends to the broker
+PUBLISH = 2
+# First message of a replica connected to the broker: {"epoch", "after"} of the last relayed event it received
+SUBSCRIBE = 3
+# Event relayed by the broker to every replica, its metadata carries "relay": [epoch, sequence number]
+RELAY = 4
+
+
+def pack(kind, meta, body=b''):
+    meta = json.dumps(meta).encode('utf-8')
+    return b''.join((HEADER.pack(kind, len(meta), len(body)), meta, body))
+
+
+def encode(kind, event):
+    return pack(kind, event.record(), event.body)
+
+
+def parse_address(address):
+    # (host, port) of "host:port", unix socket path otherwise
+    host, _, port = address.rpartition(':')
+    if port.isdigit() and '/' not in address:
+        return host or '127.0.0.1', int(port)
+    return address
+
+
+async def connect(address):
+    address = parse_address(address)
+    if isinstance(address, tuple):
+        return await tornado.tcpclient.TCPClient().connect(*address)
+    stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+    return await stream.connect(address)
+
+
+async def read_message(stream):
+    kind, meta_len, body_len = HEADER.unpack(await stream.read_bytes(HEADER.size))
+    meta = json.loads((await stream.read_bytes(meta_len)).decode('utf-8'))
+    body = await stream.read_bytes(body_len) if body_len else b''
+    return kind, meta, body
+
+
+class LocalFanout(object):
+    # Single process fan-out, events go straight to the local sessions
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, event):
+        self.deliver(event)
+
+    def stats(self):
+        return {'workers': 1}
+
+
+class Peer(object):
+    # Ordered outgoing unix socket stream to another worker, messages wait in a bounded
+    # queue while the worker is (re)connecting
+
+    def __init__(self, path, max_messages):
+        self.path = path
+        self.messages = collections.deque(maxlen=max_messages)
+        self.dropped = 0
+        self.stream = None
+        self._ready = tornado.locks.Event()
+
+    def send(self, message):
+        if len(self.messages) == self.messages.maxlen:
+            self.dropped += 1
+        self.messages.append(message)
+        self._ready.set()
+
+    async def connect(self):
+        delay = 0.1
+        while True:
+            try:
+                return await connect(self.path)
+            except (OSError, tornado.iostream.StreamClosedError):
+                await tornado.gen.sleep(delay)
+                delay = min(delay * 2, 5)
+
+    async def run(self):
+        while True:
+            if self.stream is None or self.stream.closed():
+                self.stream = await self.connect()
+            while not self.messages:
+                self._ready.clear()
+                await self._ready.wait()
+            message = self.messages[0]
+            try:
+                await self.stream.write(message)
+            except tornado.iostream.StreamClosedError:
+                LOGGER.warning('--- Worker socket %s closed, reconnecting', self.path)
+                continue
+            self.messages.popleft()
+
+
+class WorkerFanout(tornado.tcpserver.TCPServer):
+    # Fan-out between forked server workers over unix sockets. Every event is broadcast by
+    # the worker owning its repository, which delivers it to its own sessions and publishes
+    # it to every other worker. One owner per repository and ordered socket streams keep
+    # the delivery order of each repository the same on every worker.
+
+    def __init__(self, directory, worker, workers, deliver, load, max_messages, admit=None):
+        super(WorkerFanout, self).__init__()
+        self.directory = directory
+        self.worker = worker
+        self.workers = workers
+        # deliver(event) broadcasts to local sessions, load(meta, body) rebuilds a received event
+        self.deliver = deliver
+        self.load = load
+        # admit(event) decides if an event forwarded by another worker is published
+        self.admit = admit or (lambda event: True)
+        self.forwarded = 0
+        self.received = 0
+        os.makedirs(directory, exist_ok=True)
+        self.peers = {
+            peer: Peer(self.path(peer), max_messages)
+            for peer in range(workers) if peer != worker
+        }
+        self.add_socket(tornado.netutil.bind_unix_socket(self.path(worker)))
+        for peer in self.peers.values():
+            tornado.ioloop.IOLoop.current().spawn_callback(peer.run)
+
+    def path(self, worker):
+        return os.path.join(self.directory, 'worker-{}.sock'.format(worker))
+
+    def owner(self, repository):
+        return zlib.crc32((repository or '').encode('utf-8')) % self.workers
+
+    def publish(self, event):
+        owner = self.owner(event.route[0])
+        if owner != self.worker:
+            self.forwarded += 1
+            self.peers[owner].send(encode(FORWARD, event))
+            return
+        self.deliver(event)
+        message = encode(PUBLISH, event)
+        for peer in self.peers.values():
+            peer.send(message)
+
+    async def handle_stream(self, stream, address):
+        try:
+            while True:
+                kind, meta, body = await read_message(stream)
+                event = self.load(meta, body)
+                if kind == FORWARD:
+                    if self.admit(event):
+                        self.publish(event)
+                else:
+                    self.received += 1
+                    self.deliver(event)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'worker': self.worker,
+            'forwarded': self.forwarded,
+            'received': self.received,
+            'peers': {
+                str(worker): {'queued': len(peer.messages), 'dropped': peer.dropped}
+                for worker, peer in self.peers.items()
+            }
+        }
+
+
+class BrokerFanout(object):
+    # Fan-out between server replicas on any number of hosts through the pub-sub broker of
+    # broker.py. Replicas send their events to the broker, which relays each of them in one
+    # order to every replica, the sender included. Sent events are kept until the broker relays
+    # them back and are sent again after a reconnect, a reconnecting replica gets the events
+    # relayed while it was away from the broker backlog. Ids of delivered events are remembered,
+    # so every event reaches the sessions of every replica once.
+
+    def __init__(self, address, deliver, load, max_messages, admit=None, max_ids=100000):
+        self.address = address
+        # deliver(event) broadcasts to local sessions, load(meta, body) rebuilds a received event
+        self.deliver = deliver
+        self.load = load
+        # admit(event) decides if a relayed event is delivered, replicas see the same order
+        # so they take the same decisions
+        self.admit = admit or (lambda event: True)
+        self.max_messages = max_messages
+        self.max_ids = max_ids
+        # event id -> message sent but not relayed back yet
+        self.pending = collections.OrderedDict()
+        # ids of recently delivered events
+        self.delivered = collections.OrderedDict()
+        # broker epoch and sequence number of the last relayed event
+        self.epoch = None
+        self.after = None
+        self.stream = None
+        self.published = 0
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.connections = 0
+        tornado.ioloop.IOLoop.current().spawn_callback(self.run)
+
+    def publish(self, event):
+        if len(self.pending) >= self.max_messages:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        message = encode(PUBLISH, event)
+        self.pending[event.id] = message
+        self.published += 1
+        self.send(message)
+
+    def send(self, message):
+        if self.stream is None:
+            return
+        try:
+            self.stream.write(message)
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    async def run(self):
+        delay = 0.1
+        while True:
+            try:
+                stream = await connect(self.address)
+            except (OSError, tornado.iostream.StreamClosedError):
+                await tornado.gen.sleep(delay)
+                delay = min(delay * 2, 5)
+                continue
+            delay = 0.1
+            self.connections += 1
+            self.stream = stream
+            self.send(pack(SUBSCRIBE, {'epoch': self.epoch, 'after': self.after}))
+            for message in list(self.pending.values()):
+                self.send(message)
+            try:
+                while True:
+                    kind, meta, body = await read_message(stream)
+                    if kind == RELAY:
+                        self.receive(meta, body)
+            except tornado.iostream.StreamClosedError:
+                LOGGER.warning('--- Broker %s closed, reconnecting', self.address)
+            self.stream = None
+
+    def receive(self, meta, body):
+        self.epoch, self.after = meta['relay']
+        event_id = meta['id']
+        self.pending.pop(event_id, None)
+        if event_id in self.delivered:
+            self.duplicates += 1
+            return
+        self.delivered[event_id] = True
+        if len(self.delivered) > self.max_ids:
+            self.delivered.popitem(last=False)
+        event = self.load(meta, body)
+        if not self.admit(event):
+            self.rejected += 1
+            return
+        self.received += 1
+        self.deliver(event)
+
+    def stats(self):
+        return {
+            'broker': self.address,
+            'connected': self.stream is not None,
+            'connections': self.connections,
+            'pending': len(self.pending),
+            'published': self.published,
+            'received': self.received,
+            'duplicates': self.duplicates,
+            'rejected': self.rejected,
+            'dropped': self.dropped
+        }
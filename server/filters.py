@@ -0,0 +1,166 @@
+import fnmatch
+import json
+import re
+
+# Filter expressions select events by their route or payload fields:
+#
+#   ref == refs/heads/main && event == push
+#   repository =~ "org/*" && !(pusher.name == bot) || head_commit.message =~ "*build please*"
+#
+# Names are repository, ref and event ( X-Github-Event ), or dotted paths into the webhook payload.
+# Operators are == and != , =~ for glob patterns, ! , && and || with parentheses for grouping.
+# Values are bare words or quoted strings, payload values that are not strings compare as json.
+
+TOKEN = re.compile(r'''\s*(?:(&&|\|\||==|!=|=~|!|\(|\))|"((?:[^"\\]|\\.)*)"|'([^']*)'|([^\s()!=~&|"']+))''')
+COMPARISONS = ('==', '!=', '=~')
+# Names of the route fields with their position in Event.route
+ROUTE_FIELDS = {'repository': 0, 'ref': 1, 'event': 2}
+# Deepest nesting of parentheses and ! the parser accepts
+MAX_DEPTH = 32
+
+
+class FilterError(ValueError):
+    pass
+
+
+def tokenize(source):
+    # [(kind, text)] with kind "op" for operators and "word" for names and values
+    tokens = []
+    position = 0
+    source = source.rstrip()
+    while position < len(source):
+        match = TOKEN.match(source, position)
+        if match is None or match.end() == position:
+            raise FilterError('unexpected {!r} at {}'.format(source[position:position + 10], position))
+        op, quoted, single, word = match.groups()
+        if op is not None:
+            tokens.append(('op', op))
+        elif quoted is not None:
+            tokens.append(('word', re.sub(r'\\(.)', r'\1', quoted)))
+        else:
+            tokens.append(('word', single if single is not None else word))
+        position = match.end()
+    return tokens
+
+
+class Parser(object):
+    # Recursive descent parser building a tree of tuples:
+    # ("or", ...), ("and", ...), ("not", tree), (comparison, name, value)
+
+    def __init__(self, source):
+        self.tokens = tokenize(source)
+        self.position = 0
+        self.depth = 0
+
+    def peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else (None, None)
+
+    def take(self, kind=None, text=None):
+        token = self.peek()
+        if token[0] is None or (kind and token[0] != kind) or (text and token[1] != text):
+            raise FilterError('expected {} at token {}'.format(text or kind, self.position))
+        self.position += 1
+        return token[1]
+
+    def parse(self):
+        tree = self.any_of()
+        if self.peek()[0] is not None:
+            raise FilterError('unexpected {!r} at token {}'.format(self.peek()[1], self.position))
+        return tree
+
+    def any_of(self):
+        parts = [self.all_of()]
+        while self.peek() == ('op', '||'):
+            self.take()
+            parts.append(self.all_of())
+        return parts[0] if len(parts) == 1 else ('or',) + tuple(parts)
+
+    def all_of(self):
+        parts = [self.unary()]
+        while self.peek() == ('op', '&&'):
+            self.take()
+            parts.append(self.unary())
+        return parts[0] if len(parts) == 1 else ('and',) + tuple(parts)
+
+    def unary(self):
+        if self.peek() in (('op', '!'), ('op', '(')):
+            self.depth += 1
+            if self.depth > MAX_DEPTH:
+                raise FilterError('filter nested deeper than {}'.format(MAX_DEPTH))
+            try:
+                if self.take() == '!':
+                    return ('not', self.unary())
+                tree = self.any_of()
+                self.take('op', ')')
+                return tree
+            finally:
+                self.depth -= 1
+        name = self.take('word')
+        op = self.take('op')
+        if op not in COMPARISONS:
+            raise FilterError('expected comparison after {!r}'.format(name))
+        return (op, name, self.take('word'))
+
+
+def canonical(tree):
+    # Same tree for expressions differing only in the order of && and || operands
+    if tree[0] in ('and', 'or'):
+        parts = sorted(set(canonical(x) for x in tree[1:]), key=repr)
+        return parts[0] if len(parts) == 1 else (tree[0],) + tuple(parts)
+    if tree[0] == 'not':
+        return ('not', canonical(tree[1]))
+    return tree
+
+
+def field(name):
+    # Function reading a named value of an event, None when the payload has no such path
+    if name in ROUTE_FIELDS:
+        index = ROUTE_FIELDS[name]
+        return lambda event: event.route[index]
+    keys = name.split('.')
+
+    def get(event):
+        value = event.payload
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                return None
+            value = value[key]
+        return value if isinstance(value, str) else json.dumps(value)
+    return get
+
+
+def compile_tree(tree):
+    op = tree[0]
+    if op in ('and', 'or'):
+        parts = [compile_tree(x) for x in tree[1:]]
+        combine = all if op == 'and' else any
+        return lambda event: combine(part(event) for part in parts)
+    if op == 'not':
+        part = compile_tree(tree[1])
+        return lambda event: not part(event)
+    get, value = field(tree[1]), tree[2]
+    if op == '==':
+        return lambda event: get(event) == value
+    if op == '!=':
+        return lambda event: get(event) != value
+    pattern = re.compile(fnmatch.translate(value))
+
+    def matches(event):
+        current = get(event)
+        return current is not None and pattern.match(current) is not None
+    return matches
+
+
+class Filter(object):
+    # Compiled filter expression, filters with equal keys select the same events
+
+    def __init__(self, source):
+        if not isinstance(source, str):
+            raise FilterError('filter is not a string')
+        self.source = source
+        self.key = canonical(Parser(source).parse())
+        self.test = compile_tree(self.key)
+
+    def __call__(self, event):
+        # event is a server Event, the payload is only read for payload names
+        return self.test(event)
@@ -0,0 +1,85 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+
+# Level of loggers without their own level in LOG_LEVELS
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# Levels of single logger categories, "category=LEVEL" separated with ","
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'tornado.access=WARNING')
+# Keep only 1 of every N records below ERROR of high volume categories, "category=N" separated with ","
+LOG_SAMPLING = os.getenv('LOG_SAMPLING', '')
+# Maximum number of records waiting for the logging thread, further records are dropped
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+# Format of written records
+LOG_FORMAT = os.getenv('LOG_FORMAT', '%(asctime)s %(levelname)s %(name)s %(message)s')
+
+
+def settings(value):
+    # "name=value,name=value" -> {name: value}
+    pairs = (x.split('=', 1) for x in value.split(',') if '=' in x)
+    return {name.strip(): setting.strip() for name, setting in pairs}
+
+
+class Fields(object):
+    # Structured key=value fields of a record, rendered only when the record is written
+
+    def __init__(self, **fields):
+        self.fields = fields
+
+    def __str__(self):
+        return ' '.join('{}={}'.format(name, value) for name, value in sorted(self.fields.items()))
+
+
+class Sampler(logging.Filter):
+    # Passes 1 of every `rate` records, errors always pass
+
+    def __init__(self, rate):
+        super(Sampler, self).__init__()
+        self.rate = max(1, rate)
+        self.count = 0
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        self.count += 1
+        return self.count % self.rate == 1 or self.rate == 1
+
+
+class BackgroundHandler(logging.handlers.QueueHandler):
+    # Hands records over to the logging thread as they are, so message and arguments are
+    # formatted on that thread. Arguments are therefore rendered as they are when written,
+    # callers must not log objects they change afterwards.
+
+    def __init__(self, records):
+        super(BackgroundHandler, self).__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def setup():
+    # Send every record through a bounded queue to a thread writing them to stderr.
+    # Call it in the process doing the logging, after forking.
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+    listener = logging.handlers.QueueListener(records, stream, respect_handler_level=True)
+    root = logging.getLogger()
+    root.handlers = [BackgroundHandler(records)]
+    root.setLevel(LOG_LEVEL)
+    for name, level in settings(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level.upper())
+    for name, rate in settings(LOG_SAMPLING).items():
+        logging.getLogger(name).addFilter(Sampler(int(rate)))
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,118 @@
+import bisect
+import collections
+
+# Latency buckets in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Size buckets in bytes
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    # Base of the metrics exposed in the prometheus text format, one series per label values
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+
+    def key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help), '# TYPE {} {}'.format(self.name, self.kind)]
+        for name, names, values, value in self.samples():
+            lines.append('{}{} {}'.format(name, format_labels(names, values), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = collections.defaultdict(int)
+
+    def inc(self, amount=1, **labels):
+        self.values[self.key(labels)] += amount
+
+    def samples(self):
+        return [(self.name, self.labels, key, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    # Value read at scrape time from function, which returns {label values tuple: value},
+    # kind="counter" exposes totals kept elsewhere as a counter
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, function, labels=(), kind='gauge'):
+        super(Gauge, self).__init__(name, help, labels)
+        self.function = function
+        self.kind = kind
+
+    def samples(self):
+        return [(self.name, self.labels, key, value) for key, value in sorted(self.function().items())]
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=()):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self.counts = {}
+        self.sums = collections.defaultdict(float)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        counts = self.counts.get(key)
+        if counts is None:
+            counts = self.counts[key] = [0] * len(self.buckets)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def samples(self):
+        samples = []
+        names = self.labels + ('le',)
+        for key, counts in sorted(self.counts.items()):
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                samples.append((self.name + '_bucket', names, key + (format_value(bound),), total))
+            samples.append((self.name + '_sum', self.labels, key, self.sums[key]))
+            samples.append((self.name + '_count', self.labels, key, total))
+        return samples
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        return '\n'.join(metric.render() for metric in self.metrics) + '\n'
@@ -1,83 +1,1264 @@
 import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
+import tornado.locks
+import tornado.queues
+import tornado.gen
 import tornado.web
+import tornado.netutil
+import tornado.iostream
+import tornado.process
+import collections
+import itertools
+import hashlib
+import hmac
 import time
 import uuid
 import json
 import datetime
 import logging
 import urllib
+import os
+import tempfile
+import logs
+from eventlog import EventLog
+from fanout import LocalFanout, WorkerFanout, BrokerFanout
+from filters import Filter, FilterError
+from metrics import Registry, Counter, Gauge, Histogram, LATENCY_BUCKETS, SIZE_BUCKETS
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+# Maximum number of events waiting in one websocket session outbound queue
+SESSION_MAX_EVENTS = int(os.getenv('SESSION_MAX_EVENTS', '1000'))
+# Maximum number of bytes waiting in one websocket session outbound queue
+SESSION_MAX_BYTES = int(os.getenv('SESSION_MAX_BYTES', str(64 * 1024 * 1024)))
+# What to do with a session that falls behind: "disconnect" closes it, "degrade" drops its oldest events
+SLOW_CONSUMER_POLICY = os.getenv('SLOW_CONSUMER_POLICY', 'disconnect')
+# Envelope sent to sessions of each websocket subprotocol, sessions without one get v1
+SUBPROTOCOLS = collections.OrderedDict([
+    ('tightbeam.v2+json', 'v2'),
+    ('tightbeam.v1+json', 'v1'),
+])
+# Binary encodings of the v2 envelope, offered when their module is installed
+if msgpack is not None:
+    SUBPROTOCOLS['tightbeam.v2+msgpack'] = 'msgpack'
+if cbor2 is not None:
+    SUBPROTOCOLS['tightbeam.v2+cbor'] = 'cbor'
+# Envelopes sent in binary websocket frames
+BINARY_ENVELOPES = {'msgpack', 'cbor'}
+# Directory of the on-disk event log used to resume reconnecting clients, empty to disable it
+EVENT_LOG_DIR = os.getenv('EVENT_LOG_DIR', os.path.join(tempfile.gettempdir(), 'tightbeam-events'))
+# Size of one event log segment file
+EVENT_LOG_SEGMENT_BYTES = int(os.getenv('EVENT_LOG_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+# Oldest event log segments are removed above this total size or age
+EVENT_LOG_RETENTION_BYTES = int(os.getenv('EVENT_LOG_RETENTION_BYTES', str(1024 * 1024 * 1024)))
+EVENT_LOG_RETENTION_SECONDS = int(os.getenv('EVENT_LOG_RETENTION_SECONDS', str(7 * 24 * 3600)))
+# Maximum number of received webhooks waiting for broadcast, webhooks over it get 503
+INGEST_QUEUE_SIZE = int(os.getenv('INGEST_QUEUE_SIZE', '1000'))
+# Seconds github is asked to wait before redelivering a webhook rejected with 503
+INGEST_RETRY_AFTER = int(os.getenv('INGEST_RETRY_AFTER', '5'))
+# Secret of the github webhook, when set webhooks without a valid X-Hub-Signature are rejected
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Maximum size of a webhook body, github does not send payloads over 25MB
+INGEST_MAX_BODY_BYTES = int(os.getenv('INGEST_MAX_BODY_BYTES', str(25 * 1024 * 1024)))
+# X-Github-Delivery ids remembered to drop redelivered webhooks, and for how many seconds
+DELIVERY_CACHE_SIZE = int(os.getenv('DELIVERY_CACHE_SIZE', '10000'))
+DELIVERY_CACHE_TTL = int(os.getenv('DELIVERY_CACHE_TTL', str(24 * 3600)))
+# Port of the http and websocket server
+PORT = int(os.getenv('PORT', '8182'))
+# Number of forked server processes sharing the port with SO_REUSEPORT
+WORKERS = int(os.getenv('WORKERS', '1'))
+# Directory of the unix sockets used to fan out events between workers
+WORKERS_SOCKET_DIR = os.getenv('WORKERS_SOCKET_DIR', os.path.join(tempfile.gettempdir(), 'tightbeam-workers'))
+# Maximum number of events waiting for a worker that is not connected
+WORKERS_MAX_QUEUED = int(os.getenv('WORKERS_MAX_QUEUED', '10000'))
+# How events reach the sessions of other processes: "local" ( this process only ), "workers" ( forked
+# workers over unix sockets ) or "broker" ( replicas on any host through broker.py at FANOUT_BROKER )
+FANOUT_BACKEND = os.getenv('FANOUT_BACKEND', 'workers' if WORKERS > 1 else 'local')
+# Address of the fan-out broker, "host:port" or a unix socket path
+FANOUT_BROKER = os.getenv('FANOUT_BROKER', '127.0.0.1:8183')
+# Maximum number of events waiting for the broker to relay them
+FANOUT_BROKER_MAX_QUEUED = int(os.getenv('FANOUT_BROKER_MAX_QUEUED', '10000'))
+# permessage-deflate websocket compression, "false" to disable it
+WS_COMPRESSION = os.getenv('WS_COMPRESSION', 'true').lower() == 'true'
+# Messages shorter than this are sent uncompressed
+WS_COMPRESSION_MIN_BYTES = int(os.getenv('WS_COMPRESSION_MIN_BYTES', '1024'))
+# zlib compression level, memory level and window bits of the server compressor
+WS_COMPRESSION_LEVEL = int(os.getenv('WS_COMPRESSION_LEVEL', '6'))
+WS_COMPRESSION_MEM_LEVEL = int(os.getenv('WS_COMPRESSION_MEM_LEVEL', '8'))
+WS_COMPRESSION_WINDOW_BITS = int(os.getenv('WS_COMPRESSION_WINDOW_BITS', '15'))
+# Number of recently deflated messages whose compressed bytes are shared by all sessions
+WS_COMPRESSION_CACHE = int(os.getenv('WS_COMPRESSION_CACHE', '64'))
+# Maximum bytes of those messages and their compressed bytes, the latest message is kept even when over it
+WS_COMPRESSION_CACHE_BYTES = int(os.getenv('WS_COMPRESSION_CACHE_BYTES', str(32 * 1024 * 1024)))
+# Webhooks per minute and burst size allowed for one repository, 0 for no limit
+INGEST_REPO_RATE = float(os.getenv('INGEST_REPO_RATE', '300'))
+INGEST_REPO_BURST = int(os.getenv('INGEST_REPO_BURST', '60'))
+# Webhooks per minute and burst size allowed for one source ip, 0 for no limit
+# (github sends every webhook from a few addresses, so it is off by default)
+INGEST_IP_RATE = float(os.getenv('INGEST_IP_RATE', '0'))
+INGEST_IP_BURST = int(os.getenv('INGEST_IP_BURST', '120'))
+# What to do with webhooks of a repository over its limit: "queue" holds them until the repository
+# has tokens again, "reject" answers 429. Webhooks of a source ip over its limit are always rejected.
+INGEST_LIMIT_POLICY = os.getenv('INGEST_LIMIT_POLICY', 'queue')
+# Maximum number of webhooks held for one repository over its limit, further ones are rejected
+INGEST_LIMIT_QUEUE_SIZE = int(os.getenv('INGEST_LIMIT_QUEUE_SIZE', '100'))
+# Maximum bytes of bodies held for all repositories over their limits together, further ones are rejected
+INGEST_LIMIT_QUEUE_BYTES = int(os.getenv('INGEST_LIMIT_QUEUE_BYTES', str(64 * 1024 * 1024)))
+# Recent events kept in memory for the long-poll and event-stream endpoints, at most this many
+# and this many bytes of bodies and encoded frames
+RECENT_EVENTS_MAX = int(os.getenv('RECENT_EVENTS_MAX', '10000'))
+RECENT_EVENTS_MAX_BYTES = int(os.getenv('RECENT_EVENTS_MAX_BYTES', str(64 * 1024 * 1024)))
+# Longest time a GET /events request waits for events
+LONG_POLL_TIMEOUT = float(os.getenv('LONG_POLL_TIMEOUT', '30'))
+# Seconds between keepalive comments of an idle event stream
+EVENT_STREAM_KEEPALIVE = float(os.getenv('EVENT_STREAM_KEEPALIVE', '15'))
+# Seconds between pings measuring round trip time of every websocket session
+PING_RTT_INTERVAL = int(os.getenv('PING_RTT_INTERVAL', '10'))
+
+# Logger categories, see LOG_LEVELS / LOG_SAMPLING in logs.py
+SESSION_LOGGER = logging.getLogger('tightbeam.session')
+BROADCAST_LOGGER = logging.getLogger('tightbeam.broadcast')
+INGEST_LOGGER = logging.getLogger('tightbeam.ingest')
+HEARTBEAT_LOGGER = logging.getLogger('tightbeam.heartbeat')
+
+METRICS = Registry()
+WEBHOOKS = METRICS.register(Counter(
+    'tightbeam_webhooks_total', 'Received webhooks by ingest result', ['status']))
+PAYLOAD_BYTES = METRICS.register(Histogram(
+    'tightbeam_webhook_payload_bytes', 'Size of accepted webhook bodies', SIZE_BUCKETS))
+DELIVERY_LATENCY = METRICS.register(Histogram(
+    'tightbeam_delivery_latency_seconds', 'Time from webhook ingest until its websocket write is flushed',
+    LATENCY_BUCKETS, ['envelope']))
+DROPPED = METRICS.register(Counter(
+    'tightbeam_events_dropped_total', 'Events dropped from session outbound queues', ['reason']))
+LIMITED = METRICS.register(Counter(
+    'tightbeam_webhooks_limited_total', 'Webhooks over a repository or source ip rate limit', ['limit', 'action']))
+EVICTED = METRICS.register(Counter(
+    'tightbeam_sessions_evicted_total', 'Sessions closed because they could not keep up'))
+METRICS.register(Gauge(
+    'tightbeam_sessions', 'Open websocket sessions by envelope',
+    lambda: collections.Counter((session.envelope,) for session in WSHandler.SESSIONS), ['envelope']))
+METRICS.register(Gauge(
+    'tightbeam_session_queue_depth', 'Events waiting in the outbound queue of a session',
+    lambda: {(session.name,): len(session.outbox) for session in WSHandler.SESSIONS}, ['session']))
+METRICS.register(Gauge(
+    'tightbeam_session_queue_bytes', 'Bytes waiting in the outbound queue of a session',
+    lambda: {(session.name,): session.outbox.bytes for session in WSHandler.SESSIONS}, ['session']))
+METRICS.register(Gauge(
+    'tightbeam_session_ping_rtt_seconds', 'Last ping round trip time of a session',
+    lambda: {(session.name,): session.rtt for session in WSHandler.SESSIONS if session.rtt is not None},
+    ['session']))
+METRICS.register(Gauge(
+    'tightbeam_ingest_queue_depth', 'Webhooks waiting for the dispatcher',
+    lambda: {(): MainHandler.QUEUE.qsize()}))
+METRICS.register(Gauge(
+    'tightbeam_ingest_deferred', 'Webhooks held back by the rate limit of their repository',
+    lambda: {(): sum(len(x) for x in MainHandler.DEFERRED.values())}))
+METRICS.register(Gauge(
+    'tightbeam_recent_events', 'Events and bytes kept for long-poll and event-stream clients',
+    lambda: {('events',): len(WSHandler.RECENT), ('bytes',): WSHandler.RECENT.bytes}, ['unit']))
+METRICS.register(Gauge(
+    'tightbeam_websocket_bytes_out_total', 'Bytes sent to websocket sessions before and after compression',
+    lambda: dict(zip([('message',), ('wire',)], WSHandler.total_bytes_out())), ['stage'], kind='counter'))
+
+
+class Outbox(object):
+    # Bounded queue of messages waiting to be written to one websocket session
+
+    def __init__(self, max_events, max_bytes):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.messages = collections.deque()
+        self.bytes = 0
+        self.sent = 0
+        self.dropped = 0
+        self.closed = False
+        self.paused = False
+        self._ready = tornado.locks.Event()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def full(self, size):
+        return len(self.messages) >= self.max_events or self.bytes + size > self.max_bytes
+
+    def put(self, message, size, seq=None, ingested=None):
+        self.messages.append((message, size, seq, ingested))
+        self.bytes += size
+        self._ready.set()
+
+    def drop_oldest(self):
+        message, size, seq, ingested = self.messages.popleft()
+        self.bytes -= size
+        self.dropped += 1
+        DROPPED.inc(reason='slow_consumer')
+
+    def discard_upto(self, seq):
+        # Forget queued messages already sent from the event log
+        while self.messages and self.messages[0][2] is not None and self.messages[0][2] <= seq:
+            message, size, _, _ = self.messages.popleft()
+            self.bytes -= size
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+        self._ready.set()
+
+    async def get(self):
+        # Wait for the next (message, ingest time), returns None once the outbox is closed
+        while not self.messages or self.paused:
+            if self.closed:
+                return None
+            self._ready.clear()
+            await self._ready.wait()
+        message, size, seq, ingested = self.messages.popleft()
+        self.bytes -= size
+        return message, ingested
+
+    def close(self):
+        self.closed = True
+        self.dropped += len(self.messages)
+        if self.messages:
+            DROPPED.inc(len(self.messages), reason='closed')
+        self.messages.clear()
+        self.bytes = 0
+        self._ready.set()
+
+    def stats(self):
+        return {
+            'queued': len(self.messages),
+            'queued_bytes': self.bytes,
+            'sent': self.sent,
+            'dropped': self.dropped
+        }
+
+
+class SubscriptionIndex(object):
+    # Index from (repository, ref, X-Github-Event) to the sessions interested in it,
+    # "*" in any position of a key matches every value. Sessions of a key are grouped by
+    # filter expression, so each distinct filter is evaluated once per event for all of them.
+
+    ANY = '*'
+
+    def __init__(self):
+        # route key -> {filter key: sessions}, sessions without a filter are under None
+        self.routes = collections.defaultdict(lambda: collections.defaultdict(set))
+        self.keys = {}
+        # session -> filter key
+        self.filters = {}
+        # filter key -> [Filter, number of sessions using it]
+        self.compiled = {}
+
+    def subscribe(self, session, repositories=None, refs=None, events=None, expression=None):
+        self.unsubscribe(session)
+        keys = [
+            (repository, ref, event)
+            for repository in repositories or [self.ANY]
+            for ref in refs or [self.ANY]
+            for event in events or [self.ANY]
+        ]
+        filter_key = None
+        if expression is not None:
+            filter_key = expression.key
+            self.compiled.setdefault(filter_key, [expression, 0])[1] += 1
+            self.filters[session] = filter_key
+        for key in keys:
+            self.routes[key][filter_key].add(session)
+        self.keys[session] = set(keys)
+
+    def unsubscribe(self, session):
+        filter_key = self.filters.pop(session, None)
+        for key in self.keys.pop(session, []):
+            groups = self.routes[key]
+            groups[filter_key].discard(session)
+            if not groups[filter_key]:
+                del groups[filter_key]
+            if not groups:
+                del self.routes[key]
+        if filter_key is not None:
+            self.compiled[filter_key][1] -= 1
+            if not self.compiled[filter_key][1]:
+                del self.compiled[filter_key]
+
+    def match(self, repository, ref, event, webhook=None):
+        # Only the eight exact or wildcard combinations of the key are looked up,
+        # so the cost depends on the number of matching sessions only. Filters
+        # are evaluated against webhook, the Event being broadcast.
+        matched = set()
+        results = {}
+        for r in (repository, self.ANY):
+            for f in (ref, self.ANY):
+                for e in (event, self.ANY):
+                    groups = self.routes.get((r, f, e))
+                    if not groups:
+                        continue
+                    for filter_key, sessions in groups.items():
+                        if filter_key is not None:
+                            if filter_key not in results:
+                                results[filter_key] = webhook is not None and self.compiled[filter_key][0](webhook)
+                            if not results[filter_key]:
+                                continue
+                        matched.update(sessions)
+        return matched
+
+    def accepts(self, session, repository, ref, event):
+        keys = self.keys.get(session, ())
+        return any(
+            (r, f, e) in keys
+            for r in (repository, self.ANY)
+            for f in (ref, self.ANY)
+            for e in (event, self.ANY)
+        )
+
+    def passes(self, session, webhook):
+        # Whether the filter of session, if any, selects webhook
+        filter_key = self.filters.get(session)
+        return filter_key is None or self.compiled[filter_key][0](webhook)
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class DeliveryCache(object):
+    # Recently admitted X-Github-Delivery ids in admission order, which is also expiry order.
+    # Entries expire after ttl seconds and the oldest ones are evicted above max_entries to cap memory use.
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, delivery_id):
+        # True for a delivery id remembered within ttl
+        if not delivery_id:
+            return False
+        now = time.time()
+        while self.entries:
+            oldest, expires = next(iter(self.entries.items()))
+            if expires > now:
+                break
+            del self.entries[oldest]
+        if delivery_id in self.entries:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def remember(self, delivery_id):
+        # Call only once the delivery is admitted, a rejected one must stay deliverable again
+        if not delivery_id:
+            return
+        self.entries.pop(delivery_id, None)
+        self.entries[delivery_id] = time.time() + self.ttl
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def admit(self, delivery_id):
+        # seen and remember in one, for callers delivering whatever they admit
+        if self.seen(delivery_id):
+            return False
+        self.remember(delivery_id)
+        return True
+
+    def stats(self):
+        return {'entries': len(self.entries), 'hits': self.hits, 'misses': self.misses}
+
+
+class TokenBuckets(object):
+    # Token bucket per key, refilled with rate tokens per minute up to burst. Buckets of the
+    # max_keys most recently used keys are kept, a forgotten key starts again with a full bucket.
+
+    def __init__(self, rate, burst, max_keys=10000):
+        self.rate = rate / 60.0
+        self.burst = burst
+        self.max_keys = max_keys
+        # key -> (tokens, time of last update)
+        self.buckets = collections.OrderedDict()
+
+    def take(self, key):
+        # True when key had a token, which is used up
+        if self.rate <= 0:
+            return True
+        now = time.monotonic()
+        tokens, updated = self.buckets.pop(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        if len(self.buckets) > self.max_keys:
+            self.buckets.popitem(last=False)
+        return allowed
+
+    def delay(self, key):
+        # Seconds until key has a token again
+        if self.rate <= 0 or key not in self.buckets:
+            return 0
+        tokens, updated = self.buckets[key]
+        return max(0, (1 - tokens) / self.rate - (time.monotonic() - updated))
+
+    def stats(self):
+        return {'keys': len(self.buckets)}
+
+
+class RingBuffer(object):
+    # Recent events in broadcast order, the oldest are evicted above max_events or above
+    # max_bytes of bodies and frames encoded for them. Readers keep the id of the last
+    # event they read and wait for new ones.
+
+    def __init__(self, max_events, max_bytes):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.events = collections.deque()
+        # event id -> position, positions grow by one with every appended event
+        self.positions = {}
+        self.first = 0
+        self.bytes = 0
+        self.evicted = 0
+        self._changed = tornado.locks.Condition()
+
+    def append(self, event):
+        if self.max_events <= 0:
+            return
+        self.positions[event.id] = self.first + len(self.events)
+        self.events.append(event)
+        self.bytes += event.size()
+        self.evict()
+        self._changed.notify_all()
+
+    def evict(self):
+        # The newest event is kept even when it is over max_bytes on its own
+        while len(self.events) > 1 and (len(self.events) > self.max_events or self.bytes > self.max_bytes):
+            event = self.events.popleft()
+            del self.positions[event.id]
+            self.first += 1
+            self.bytes -= event.size()
+            self.evicted += 1
+
+    def frame(self, event, envelope, projection):
+        # Shared frame of a buffered event, frames encoded here count against max_bytes
+        encoded = len(event._frames)
+        frame = event.frame(envelope, projection)
+        if len(event._frames) != encoded and event.id in self.positions:
+            self.bytes += len(frame)
+            self.evict()
+        return frame
+
+    def after(self, event_id):
+        # Events after event_id, every buffered event when event_id was evicted or is unknown
+        position = self.positions.get(event_id)
+        start = 0 if position is None else position + 1 - self.first
+        return list(itertools.islice(self.events, start, None))
+
+    def last_id(self):
+        return self.events[-1].id if self.events else None
+
+    def wait(self, timeout):
+        # Resolves to True when an event is appended within timeout seconds
+        return self._changed.wait(timeout=datetime.timedelta(seconds=max(0, timeout)))
+
+    def stats(self):
+        return {'events': len(self.events), 'bytes': self.bytes, 'evicted': self.evicted}
+
+    def __len__(self):
+        return len(self.events)
+
+
+def webhook_payload(headers, body):
+    # (json document bytes, decoded payload) of a github webhook body, both None when it is not json
+    raw = body
+    if headers.get('Content-Type', '').startswith('application/x-www-form-urlencoded'):
+        raw = urllib.parse.parse_qs(body.decode('utf-8')).get('payload', [''])[0].encode('utf-8')
+    try:
+        return raw, json.loads(raw.decode('utf-8'))
+    except ValueError:
+        return None, None
+
+
+def route_key(headers, payload):
+    # (repository, ref, event) of a github webhook used for subscription routing
+    event = headers.get('X-Github-Event')
+    if not isinstance(payload, dict):
+        return None, None, event
+    repository = (payload.get('repository') or {}).get('full_name')
+    return repository, payload.get('ref'), event
+
+
+def projection_key(spec):
+    # Canonical (payload paths, header names) of a subscription projection, None for full events
+    if not isinstance(spec, dict):
+        return None
+    fields = tuple(sorted(set(str(x) for x in spec.get('fields') or [])))
+    headers = tuple(sorted(set(str(x).lower() for x in spec.get('headers') or [])))
+    if not fields and not headers:
+        return None
+    return fields, headers
+
+
+def project_payload(payload, fields):
+    # Copy of payload with only the dotted paths in fields, keeping their nesting
+    if not fields:
+        return payload
+    projected = {}
+    for path in fields:
+        keys = path.split('.')
+        value = payload
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = projected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return projected
+
+
+class Event(object):
+    # One received webhook. Its envelope is serialized once per envelope version and projection
+    # into an immutable bytes buffer shared by the outbound queue of every session using them.
+    #
+    # v1: {"id", "headers", "timestamp", "payload": <request body as a json string>}
+    # v2: {"v": 2, "id", "headers", "timestamp", "route": [repository, ref, event], "payload": <webhook json document>},
+    #     the raw json document is spliced into the frame last without being decoded or escaped,
+    #     so clients can read the route without decoding the payload
+    # msgpack, cbor: the v2 envelope in a binary encoding
+    #
+    # A projection keeps only some payload paths and headers, the payload is then
+    # re-encoded from the projected fields. A projection of headers only sends the payload as it is.
+
+    def __init__(self, headers, body, event_id=None, timestamp=None):
+        self.id = event_id or str(uuid.uuid4())
+        self.timestamp = timestamp or str(int(time.time() * 1000))
+        self.headers = headers
+        self.body = body
+        self.raw, self._payload = webhook_payload(headers, body)
+        self.route = route_key(headers, self._payload)
+        self.seq = None
+        # Wall clock seconds of the ingest, for delivery latency
+        self.ingested = int(self.timestamp) / 1000.0
+        self._frames = {}
+        self._projections = {}
+        self.released = False
+
+    @classmethod
+    def from_record(cls, meta, body):
+        return cls(meta['headers'], body, meta['id'], meta['timestamp'])
+
+    def record(self):
+        # Metadata stored next to the request body in the event log
+        return {'id': self.id, 'timestamp': self.timestamp, 'headers': self.headers, 'route': self.route}
+
+    @property
+    def payload(self):
+        # Decoded webhook payload, decoded again on every use once the event is released
+        if self.released and self.raw is not None:
+            return json.loads(self.raw.decode('utf-8'))
+        return self._payload
+
+    def release(self):
+        # Called once the event is broadcast, buffered events only keep bytes counted by size()
+        self.released = True
+        self._payload = None
+        self._projections = {}
+
+    def size(self):
+        # Bytes of the body, of the json document of a form-encoded body and of every frame encoded so far
+        raw = len(self.raw) if self.raw is not None and self.raw is not self.body else 0
+        return len(self.body) + raw + sum(len(x) for x in self._frames.values())
+
+    def frame(self, envelope='v1', projection=None):
+        key = (envelope, projection)
+        frame = self._frames.get(key)
+        if frame is None:
+            frame = self._frames[key] = getattr(self, 'encode_' + envelope)(projection)
+        return frame
+
+    def project(self, projection):
+        # (headers, payload) of a projection, computed once and shared by every envelope
+        projected = self._projections.get(projection)
+        if projected is None:
+            fields, names = projection
+            headers = {x: y for x, y in self.headers.items() if x.lower() in names} if names else self.headers
+            payload = self.payload
+            payload = project_payload(payload, fields) if isinstance(payload, dict) else payload
+            projected = (headers, payload)
+            if not self.released:
+                self._projections[projection] = projected
+        return projected
+
+    def encode_v1(self, projection=None):
+        if projection is None:
+            headers, payload = self.headers, self.body.decode('utf-8')
+        else:
+            headers, payload = self.project(projection)
+            # a projection of headers only keeps the body as github sent it
+            payload = json.dumps(payload) if self.raw is not None and projection[0] else self.body.decode('utf-8')
+        return json.dumps({
+            "id": self.id,
+            "headers": headers,
+            "timestamp": self.timestamp,
+            "payload": payload
+        }).encode('utf-8')
+
+    def encode_v2(self, projection=None):
+        headers, payload = self.headers, self.payload
+        if projection is not None:
+            headers, payload = self.project(projection)
+        meta = json.dumps({
+            "v": 2,
+            "id": self.id,
+            "headers": headers,
+            "timestamp": self.timestamp,
+            "route": self.route
+        }).encode('utf-8')
+        if self.raw is None:
+            # Not a json document, sent as a string like in v1
+            payload = json.dumps(self.body.decode('utf-8', 'replace')).encode('utf-8')
+        elif projection is None or not projection[0]:
+            payload = self.raw
+        else:
+            payload = json.dumps(payload).encode('utf-8')
+        return b''.join((meta[:-1], b', "payload": ', payload, b'}'))
+
+    def binary_envelope(self, projection=None):
+        headers, payload = self.headers, self.payload
+        if projection is not None:
+            headers, payload = self.project(projection)
+        return {
+            "v": 2,
+            "id": self.id,
+            "headers": headers,
+            "timestamp": self.timestamp,
+            "route": self.route,
+            "payload": payload if self.raw is not None else self.body.decode('utf-8', 'replace')
+        }
+
+    def encode_msgpack(self, projection=None):
+        return msgpack.packb(self.binary_envelope(projection), use_bin_type=True)
+
+    def encode_cbor(self, projection=None):
+        return cbor2.dumps(self.binary_envelope(projection))
+
+
+class SharedDeflate(object):
+    # Compressor of a session without server context takeover. Every message is deflated on its own,
+    # so a frame shared by many sessions has the same deflated bytes for all sessions using the
+    # same window, they are computed once and kept for the WS_COMPRESSION_CACHE latest frames
+    # within WS_COMPRESSION_CACHE_BYTES of messages and deflated messages.
+
+    # (window bits, message) -> deflated message
+    CACHE = collections.OrderedDict()
+    cached_bytes = 0
+    deflated = 0
+    shared = 0
+
+    def __init__(self, compressor, max_wbits):
+        self.compressor = compressor
+        self.max_wbits = max_wbits
+
+    def compress(self, message):
+        key = (self.max_wbits, message)
+        deflated = self.CACHE.get(key)
+        if deflated is not None:
+            SharedDeflate.shared += 1
+            self.CACHE.move_to_end(key)
+            return deflated
+        SharedDeflate.deflated += 1
+        deflated = self.CACHE[key] = self.compressor.compress(message)
+        SharedDeflate.cached_bytes += len(message) + len(deflated)
+        while len(self.CACHE) > 1 and (len(self.CACHE) > WS_COMPRESSION_CACHE or SharedDeflate.cached_bytes > WS_COMPRESSION_CACHE_BYTES):
+            (_, evicted), evicted_deflated = self.CACHE.popitem(last=False)
+            SharedDeflate.cached_bytes -= len(evicted) + len(evicted_deflated)
+        return deflated
+
+    @classmethod
+    def clear(cls):
+        cls.CACHE.clear()
+        cls.cached_bytes = 0
+
+    @classmethod
+    def stats(cls):
+        return {'cached': len(cls.CACHE), 'bytes': cls.cached_bytes, 'deflated': cls.deflated, 'shared': cls.shared}
+
+
+class DeflateProtocol(tornado.websocket.WebSocketProtocol13):
+    # permessage-deflate that leaves small messages uncompressed, caps the server window and
+    # shares deflated frames between sessions, see SharedDeflate
+
+    def _get_compressor_options(self, side, agreed_parameters, compression_options=None):
+        options = super(DeflateProtocol, self)._get_compressor_options(side, agreed_parameters, compression_options)
+        if side == 'server':
+            # Clients can always inflate messages deflated with a smaller window than negotiated
+            options['max_wbits'] = max(9, min(options['max_wbits'], WS_COMPRESSION_WINDOW_BITS))
+            # Answered to every client offering permessage-deflate, the agreed parameters are
+            # echoed in the handshake response
+            agreed_parameters['server_no_context_takeover'] = None
+            options['persistent'] = False
+            self._server_wbits = options['max_wbits']
+        return options
+
+    def _create_compressors(self, side, agreed_parameters, compression_options=None):
+        super(DeflateProtocol, self)._create_compressors(side, agreed_parameters, compression_options)
+        if side == 'server':
+            self._compressor = SharedDeflate(self._compressor, self._server_wbits)
+
+    def write_message(self, message, binary=False):
+        compressor = self._compressor
+        if compressor is None or len(message) >= WS_COMPRESSION_MIN_BYTES:
+            return super(DeflateProtocol, self).write_message(message, binary)
+        # Sent without the RSV1 bit, which permessage-deflate allows for any message
+        self._compressor = None
+        try:
+            return super(DeflateProtocol, self).write_message(message, binary)
+        finally:
+            self._compressor = compressor
+
+    def bytes_out(self):
+        # (message bytes, bytes on the wire) sent on this connection
+        return self._message_bytes_out, self._wire_bytes_out
+
 
 class WSHandler(tornado.websocket.WebSocketHandler):
 
     SESSIONS = []
+    SUBSCRIPTIONS = SubscriptionIndex()
+    # EventLog of broadcast events, None when disabled
+    LOG = None
+    # Recent broadcast events read by the long-poll and event-stream endpoints
+    RECENT = RingBuffer(RECENT_EVENTS_MAX, RECENT_EVENTS_MAX_BYTES)
+    # Bytes sent to closed sessions before and after compression
+    MESSAGE_BYTES_OUT = 0
+    WIRE_BYTES_OUT = 0
 
     def open(self, *args, **kwargs):
-        logging.warning('-- Connection is open --')
+        SESSION_LOGGER.debug('-- Connection is open --')
         if self not in self.SESSIONS:
+            self.envelope = SUBPROTOCOLS.get(self.selected_subprotocol, 'v1')
+            self.binary = self.envelope in BINARY_ENVELOPES
+            self.projection = None
+            self.protocol = self.ws_connection
+            self.name = str(id(self))
+            self.rtt = None
+            self.outbox = Outbox(SESSION_MAX_EVENTS, SESSION_MAX_BYTES)
             self.SESSIONS.append(self)
-            logging.warning('--- Client Session added: {}'.format(self))
+            # Sessions receive everything until they send their own subscription
+            self.SUBSCRIPTIONS.subscribe(self)
+            tornado.ioloop.IOLoop.current().spawn_callback(self.drain)
+            SESSION_LOGGER.info('--- Client Session added: %s', logs.Fields(
+                session=self.name, ip=self.request.remote_ip, envelope=self.envelope))
 
     def on_close(self):
-        logging.warning('-- Connection is closed --')
+        SESSION_LOGGER.debug('-- Connection is closed --')
+        message_bytes, wire_bytes = self.bytes_out()
+        WSHandler.MESSAGE_BYTES_OUT += message_bytes
+        WSHandler.WIRE_BYTES_OUT += wire_bytes
         if self in self.SESSIONS:
             self.SESSIONS.remove(self)
-            logging.warning('--- Client Session removed: {}'.format(self))
+            self.SUBSCRIPTIONS.unsubscribe(self)
+            self.outbox.close()
+            SESSION_LOGGER.info('--- Client Session removed: %s', logs.Fields(session=self.name, **self.outbox.stats()))
 
-    def on_message(self, message):
-        logging.warning('--- Message recived: {}'.format(message))
+    def get_compression_options(self):
+        if not WS_COMPRESSION:
+            return None
+        return {'compression_level': WS_COMPRESSION_LEVEL, 'mem_level': WS_COMPRESSION_MEM_LEVEL}
+
+    def get_websocket_protocol(self):
+        protocol = super(WSHandler, self).get_websocket_protocol()
+        if type(protocol) is tornado.websocket.WebSocketProtocol13:
+            protocol.__class__ = DeflateProtocol
+        return protocol
+
+    def bytes_out(self):
+        protocol = getattr(self, 'protocol', None)
+        if isinstance(protocol, DeflateProtocol):
+            return protocol.bytes_out()
+        return 0, 0
+
+    def on_pong(self, data):
+        # Pongs of PING_RTT_INTERVAL pings carry the time the ping was sent
+        try:
+            self.rtt = time.time() - float(data)
+        except ValueError:
+            pass
 
     @classmethod
-    def broadcast(cls,data):
+    def ping_sessions(cls):
         for session in cls.SESSIONS:
-            logging.warning("--- Broadcast to {} ---".format(session))
-            session.write_message(data)
+            try:
+                session.ping(repr(time.time()).encode('ascii'))
+            except tornado.websocket.WebSocketClosedError:
+                pass
+
+    def on_message(self, message):
+        SESSION_LOGGER.debug('--- Message recived from %s: %s', self.name, message)
+        try:
+            msg = json.loads(message)
+        except ValueError:
+            return
+        if isinstance(msg, dict) and msg.get('type') == 'subscribe' and self in self.SESSIONS:
+            try:
+                expression = Filter(msg['filter']) if msg.get('filter') else None
+            except FilterError as e:
+                SESSION_LOGGER.warning('--- Client Session %s sent invalid filter: %s', self.name, e)
+                self.close(1008, 'invalid filter')
+                return
+            self.SUBSCRIPTIONS.subscribe(
+                self,
+                repositories=msg.get('repositories'),
+                refs=msg.get('refs'),
+                events=msg.get('events'),
+                expression=expression
+            )
+            self.projection = projection_key(msg.get('projection'))
+            SESSION_LOGGER.info('--- Client Session %s subscribed: %s', self.name, message)
+        elif isinstance(msg, dict) and msg.get('type') == 'resume' and self in self.SESSIONS and self.LOG:
+            tornado.ioloop.IOLoop.current().spawn_callback(self.replay, msg.get('last_event_id'))
+
+    async def replay(self, last_event_id):
+        # Stream events logged after last_event_id, live events wait in the paused outbox
+        # and are dropped from it when the replay already covered them
+        self.outbox.pause()
+        last_seq, count = -1, 0
+        try:
+            for meta, body in self.LOG.read_after(last_event_id):
+                last_seq = meta['seq']
+                if self.SUBSCRIPTIONS.accepts(self, *meta['route']):
+                    event = Event.from_record(meta, body)
+                    if not self.SUBSCRIPTIONS.passes(self, event):
+                        continue
+                    await self.write_message(event.frame(self.envelope, self.projection), self.binary)
+                    count += 1
+        except tornado.websocket.WebSocketClosedError:
+            return
+        finally:
+            self.outbox.discard_upto(last_seq)
+            self.outbox.resume()
+        SESSION_LOGGER.info('--- Client Session resumed: %s', logs.Fields(
+            session=self.name, last_event_id=last_event_id, events=count))
+
+    async def drain(self):
+        # Write queued messages one at a time, waiting for each write to be flushed
+        # so a slow client only holds back its own queue. Messages are encoded bytes,
+        # json envelopes go in text frames and binary encodings in binary frames.
+        while True:
+            queued = await self.outbox.get()
+            if queued is None:
+                break
+            message, ingested = queued
+            try:
+                await self.write_message(message, self.binary)
+            except tornado.websocket.WebSocketClosedError:
+                break
+            self.outbox.sent += 1
+            if ingested is not None:
+                DELIVERY_LATENCY.observe(time.time() - ingested, envelope=self.envelope)
+
+    def enqueue(self, message, size, seq=None, ingested=None):
+        if self.outbox.closed:
+            return
+        if self.outbox.full(size):
+            if SLOW_CONSUMER_POLICY == 'degrade':
+                while self.outbox and self.outbox.full(size):
+                    self.outbox.drop_oldest()
+                SESSION_LOGGER.warning('--- Slow consumer %s, dropped events: %s', self.name, self.outbox.dropped)
+            else:
+                SESSION_LOGGER.warning('--- Slow consumer evicted: %s', logs.Fields(session=self.name, **self.outbox.stats()))
+                EVICTED.inc()
+                self.SESSIONS.remove(self)
+                self.SUBSCRIPTIONS.unsubscribe(self)
+                self.outbox.close()
+                self.close(1013, 'slow consumer')
+                return
+        self.outbox.put(message, size, seq, ingested)
+
+    @classmethod
+    def broadcast(cls,event):
+        if cls.LOG is not None:
+            event.seq = cls.LOG.append(event.record(), event.body)
+        for session in cls.SUBSCRIPTIONS.match(*event.route, webhook=event):
+            BROADCAST_LOGGER.debug('--- Broadcast %s to %s ---', event.id, session.name)
+            frame = event.frame(session.envelope, session.projection)
+            session.enqueue(frame, len(frame), event.seq, event.ingested)
+        # Added after the websocket frames so their bytes are counted
+        event.release()
+        cls.RECENT.append(event)
+
+    @classmethod
+    def total_bytes_out(cls):
+        traffic = [session.bytes_out() for session in cls.SESSIONS]
+        return cls.MESSAGE_BYTES_OUT + sum(x[0] for x in traffic), cls.WIRE_BYTES_OUT + sum(x[1] for x in traffic)
+
+    @classmethod
+    def stats(cls):
+        traffic = [session.bytes_out() for session in cls.SESSIONS]
+        message_bytes_out, wire_bytes_out = cls.total_bytes_out()
+        return {
+            'sessions': len(cls.SESSIONS),
+            'subscriptions': len(cls.SUBSCRIPTIONS.routes),
+            'filters': len(cls.SUBSCRIPTIONS.compiled),
+            'recent': cls.RECENT.stats(),
+            'evicted': EVICTED.values[()],
+            'message_bytes_out': message_bytes_out,
+            'wire_bytes_out': wire_bytes_out,
+            'compression': SharedDeflate.stats(),
+            'outbox': {
+                session.name: dict(session.outbox.stats(), message_bytes_out=message_bytes, wire_bytes_out=wire_bytes)
+                for session, (message_bytes, wire_bytes) in zip(cls.SESSIONS, traffic)
+            }
+        }
 
     @classmethod
     def heartbeat(cls):
-        logging.warning("- Hearth Bit -")
-        logging.warning("--- SESSIONS: [{}]".format(cls.SESSIONS))
+        if HEARTBEAT_LOGGER.isEnabledFor(logging.INFO):
+            HEARTBEAT_LOGGER.info('- Hearth Bit - SESSIONS: [%s]', json.dumps(cls.stats()))
         return "ok"
 
+    def select_subprotocol(self, subprotocols):
+        # First subprotocol offered by the client that has a known envelope version
+        for subprotocol in subprotocols:
+            if subprotocol in SUBPROTOCOLS:
+                return subprotocol
+        return None
+
     def check_origin(self, origin):
-        logging.warning("--- Check Origin :: {}".format(origin))
+        SESSION_LOGGER.debug('--- Check Origin :: %s', origin)
         parsed_origin = urllib.parse.urlparse(origin)
         return parsed_origin.netloc.endswith(".redhat.com")
 
+@tornado.web.stream_request_body
 class MainHandler(tornado.web.RequestHandler):
+    # Webhook bodies are streamed, the signature is checked while chunks arrive and
+    # oversized or unsigned requests are rejected before their body is read
+
+    # Signature headers github sends with the digest used for each
+    SIGNATURES = (('X-Hub-Signature-256', 'sha256', hashlib.sha256), ('X-Hub-Signature', 'sha1', hashlib.sha1))
+
+    # Received webhooks waiting for the dispatcher
+    QUEUE = tornado.queues.Queue(maxsize=INGEST_QUEUE_SIZE)
+    # Rate limits of repositories and source ips
+    REPO_LIMITS = TokenBuckets(INGEST_REPO_RATE, INGEST_REPO_BURST)
+    IP_LIMITS = TokenBuckets(INGEST_IP_RATE, INGEST_IP_BURST)
+    # repository -> webhooks over its limit waiting for tokens, in order of arrival
+    DEFERRED = {}
+    # Bytes of bodies held in DEFERRED
+    DEFERRED_BYTES = 0
+    # Fan-out delivering dispatched events to the sessions of every worker
+    FANOUT = LocalFanout(WSHandler.broadcast)
+    # Recently received X-Github-Delivery ids
+    DELIVERIES = DeliveryCache(DELIVERY_CACHE_SIZE, DELIVERY_CACHE_TTL)
+
+    def prepare(self):
+        if self.request.method != 'POST':
+            return
+        if not self.IP_LIMITS.take(self.request.remote_ip):
+            LIMITED.inc(limit='ip', action='rejected')
+            raise self.limited(self.IP_LIMITS.delay(self.request.remote_ip))
+        length = int(self.request.headers.get('Content-Length', '0') or '0')
+        if length > INGEST_MAX_BODY_BYTES:
+            WEBHOOKS.inc(status='invalid')
+            raise tornado.web.HTTPError(413, 'webhook body over {} bytes'.format(INGEST_MAX_BODY_BYTES))
+        self.request.connection.set_max_body_size(INGEST_MAX_BODY_BYTES)
+        self.signature = None
+        self.digest = None
+        if WEBHOOK_SECRET:
+            for header, name, digestmod in self.SIGNATURES:
+                if header in self.request.headers:
+                    self.signature = self.request.headers[header]
+                    self.digest = hmac.new(WEBHOOK_SECRET.encode('utf-8'), digestmod=digestmod)
+                    self.prefix = name + '='
+                    break
+            else:
+                WEBHOOKS.inc(status='invalid')
+                raise tornado.web.HTTPError(401, 'webhook without signature')
+        # Chunks are appended to one buffer which becomes the event body as it is. It grows with
+        # the received bytes, a Content-Length header alone does not reserve memory.
+        self.body = bytearray()
+
+    def data_received(self, chunk):
+        if self.digest is not None:
+            self.digest.update(chunk)
+        self.body += chunk
 
     def get(self, *args, **kwargs):
         self.render("index.html",title="Login Page /NOS-PERF")
         # self.write({'status':'ok'})
 
     def post(self, *args, **kwargs):
-        headers = {x: self.request.headers[x] for x in self.request.headers}
-        payload = self.request.body
-        data = {
-            "id": str(uuid.uuid4()),
-            "headers": headers,
-            "timestamp": str(int(time.time() * 1000)),
-            "payload": payload.decode('utf-8')
-        }
-        WSHandler.broadcast(data)
+        # Webhooks are only queued here and answered right away, github marks
+        # deliveries failed when the receiver is slow
+        if not self.body:
+            raise tornado.web.HTTPError(400, 'empty webhook body')
+        # Compared as bytes, compare_digest rejects str with non-ascii characters, header values are latin-1
+        if self.digest is not None and not hmac.compare_digest(
+                (self.prefix + self.digest.hexdigest()).encode('ascii'), self.signature.encode('latin-1')):
+            WEBHOOKS.inc(status='invalid')
+            raise tornado.web.HTTPError(401, 'invalid webhook signature')
+        if self.DELIVERIES.seen(self.request.headers.get('X-Github-Delivery')):
+            # Redelivered webhook, acknowledged so github stops retrying but not broadcast again
+            INGEST_LOGGER.info('--- Duplicate delivery %s', self.request.headers.get('X-Github-Delivery'))
+            WEBHOOKS.inc(status='duplicate')
+            self.write(json.dumps({
+                'method': 'POST',
+                'time': str(datetime.datetime.now().time()),
+                'status': 'duplicate'
+            }))
+            return
+        # The payload is parsed once here, the route decides the rate limit and later the receivers
+        event = Event({x: self.request.headers[x] for x in self.request.headers}, self.body)
+        repository = event.route[0]
+        if repository in self.DEFERRED or not self.REPO_LIMITS.take(repository):
+            if (INGEST_LIMIT_POLICY != 'queue' or len(self.DEFERRED.get(repository, ())) >= INGEST_LIMIT_QUEUE_SIZE
+                    or MainHandler.DEFERRED_BYTES + len(event.body) > INGEST_LIMIT_QUEUE_BYTES):
+                LIMITED.inc(limit='repository', action='rejected')
+                INGEST_LOGGER.info('--- Webhook of %s over rate limit, rejected', repository)
+                raise self.limited(self.REPO_LIMITS.delay(repository))
+            LIMITED.inc(limit='repository', action='deferred')
+            if repository not in self.DEFERRED:
+                self.DEFERRED[repository] = collections.deque()
+                tornado.ioloop.IOLoop.current().call_later(
+                    self.REPO_LIMITS.delay(repository), MainHandler.release, repository)
+            self.DEFERRED[repository].append(event)
+            MainHandler.DEFERRED_BYTES += len(event.body)
+            self.accepted(event, 'deferred')
+            return
+        try:
+            self.QUEUE.put_nowait(event)
+        except tornado.queues.QueueFull:
+            WEBHOOKS.inc(status='rejected')
+            INGEST_LOGGER.warning('--- Ingest queue full, webhook rejected')
+            self.set_status(503)
+            self.set_header('Retry-After', str(INGEST_RETRY_AFTER))
+            self.write(json.dumps({
+                'method': 'POST',
+                'time': str(datetime.datetime.now().time()),
+                'status': 'busy'
+            }))
+            return
+        self.accepted(event, 'accepted')
+
+    def accepted(self, event, status):
+        # Queued and deferred webhooks are broadcast, so only now their redeliveries are duplicates
+        self.DELIVERIES.remember(event.headers.get('X-Github-Delivery'))
+        WEBHOOKS.inc(status='accepted')
+        PAYLOAD_BYTES.observe(len(event.body))
+        INGEST_LOGGER.info('--- Webhook %s: %s', status, logs.Fields(
+            id=event.id, route=event.route, delivery=event.headers.get('X-Github-Delivery'), bytes=len(event.body)))
+        self.set_status(202)
         self.write(json.dumps({
             'method': 'POST',
             'time': str(datetime.datetime.now().time()),
-            'status': 'ok'
+            'status': status,
+            'id': event.id
         }))
 
+    def limited(self, delay):
+        # Answers 429 telling the sender when it has a token again
+        WEBHOOKS.inc(status='limited')
+        self.set_status(429)
+        self.set_header('Retry-After', str(int(delay) + 1))
+        self.finish(json.dumps({
+            'method': 'POST',
+            'time': str(datetime.datetime.now().time()),
+            'status': 'limited'
+        }))
+        return tornado.web.Finish()
+
+    @classmethod
+    def release(cls, repository):
+        # Move held webhooks of repository to the dispatcher while it has tokens,
+        # then wait for its next token
+        deferred = cls.DEFERRED[repository]
+        while deferred and not cls.QUEUE.full() and cls.REPO_LIMITS.take(repository):
+            event = deferred.popleft()
+            cls.DEFERRED_BYTES -= len(event.body)
+            cls.QUEUE.put_nowait(event)
+        if not deferred:
+            del cls.DEFERRED[repository]
+            return
+        delay = cls.REPO_LIMITS.delay(repository) if not cls.QUEUE.full() else INGEST_RETRY_AFTER
+        tornado.ioloop.IOLoop.current().call_later(delay, cls.release, repository)
+
+    @classmethod
+    async def dispatch(cls):
+        # Broadcast queued webhooks one by one, giving the IOLoop a turn after each
+        # so a burst of webhooks does not hold back ingest and websocket writes
+        while True:
+            event = await cls.QUEUE.get()
+            try:
+                cls.FANOUT.publish(event)
+            except Exception:
+                INGEST_LOGGER.exception('--- Broadcast of event %s failed', event.id)
+            finally:
+                cls.QUEUE.task_done()
+            await tornado.gen.sleep(0)
+
+    @classmethod
+    def stats(cls):
+        return {
+            'queued': cls.QUEUE.qsize(),
+            'accepted': WEBHOOKS.values[('accepted',)],
+            'rejected': WEBHOOKS.values[('rejected',)],
+            'invalid': WEBHOOKS.values[('invalid',)],
+            'limited': WEBHOOKS.values[('limited',)],
+            'deferred': {repository: len(x) for repository, x in cls.DEFERRED.items()},
+            'deferred_bytes': cls.DEFERRED_BYTES,
+            'repository_limits': cls.REPO_LIMITS.stats(),
+            'ip_limits': cls.IP_LIMITS.stats(),
+            'fanout': cls.FANOUT.stats(),
+            'deliveries': cls.DELIVERIES.stats()
+        }
+
+class BufferedEventsHandler(tornado.web.RequestHandler):
+    # Base of the http transports reading WSHandler.RECENT. The query arguments repositories,
+    # refs, events, fields and headers ("," separated) and filter work like the websocket subscribe
+    # message, envelope is "v2" ( default ) or "v1". Events are sent as the frames websocket sessions get.
+
+    def prepare(self):
+        lists = {
+            name: [x.strip() for x in self.get_argument(name, '').split(',') if x.strip()]
+            for name in ('repositories', 'refs', 'events', 'fields', 'headers')
+        }
+        try:
+            expression = Filter(self.get_argument('filter')) if self.get_argument('filter', '') else None
+        except FilterError as e:
+            raise tornado.web.HTTPError(400, 'invalid filter: {}'.format(e))
+        self.subscriptions = SubscriptionIndex()
+        self.subscriptions.subscribe(self, lists['repositories'], lists['refs'], lists['events'], expression)
+        self.projection = projection_key({'fields': lists['fields'], 'headers': lists['headers']})
+        self.envelope = 'v1' if self.get_argument('envelope', 'v2') == 'v1' else 'v2'
+
+    def frames(self, event_id):
+        # ([(id, frame) of matching events after event_id], id of the last event read)
+        frames = []
+        for event in WSHandler.RECENT.after(event_id):
+            event_id = event.id
+            if self.subscriptions.accepts(self, *event.route) and self.subscriptions.passes(self, event):
+                frames.append((event.id, WSHandler.RECENT.frame(event, self.envelope, self.projection)))
+        return frames, event_id
+
+
+class EventsHandler(BufferedEventsHandler):
+    # GET /events?since=<id>&timeout=<seconds> long-poll, answers
+    # {"last_event_id": <id to poll with next>, "events": [<frame>, ...]} once there are events
+    # after since, or without events after timeout. Without since only new events are sent.
+
+    async def get(self, *args, **kwargs):
+        since = self.get_argument('since', None) or WSHandler.RECENT.last_id()
+        timeout = min(float(self.get_argument('timeout', LONG_POLL_TIMEOUT)), LONG_POLL_TIMEOUT)
+        deadline = time.time() + timeout
+        while True:
+            frames, since = self.frames(since)
+            if frames or time.time() >= deadline:
+                break
+            await WSHandler.RECENT.wait(deadline - time.time())
+        self.set_header('Content-Type', 'application/json')
+        self.write(b''.join((
+            b'{"last_event_id": ', json.dumps(since).encode('utf-8'),
+            b', "events": [', b', '.join(frame for _, frame in frames), b']}'
+        )))
+
+
+class EventStreamHandler(BufferedEventsHandler):
+    # GET /events/stream text/event-stream, every event carries its id so EventSource
+    # resumes after a reconnect with Last-Event-ID, since=<id> does the same for other clients
+
+    async def get(self, *args, **kwargs):
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        since = (self.request.headers.get('Last-Event-ID') or self.get_argument('since', None)
+                 or WSHandler.RECENT.last_id())
+        try:
+            self.write(b'retry: 1000\n\n')
+            await self.flush()
+            while True:
+                frames, since = self.frames(since)
+                for event_id, frame in frames:
+                    # Line breaks of a frame continue the data field on a new line
+                    self.write(b''.join((
+                        b'id: ', event_id.encode('utf-8'), b'\ndata: ', frame.replace(b'\n', b'\ndata: '), b'\n\n'
+                    )))
+                if frames:
+                    await self.flush()
+                elif not await WSHandler.RECENT.wait(EVENT_STREAM_KEEPALIVE):
+                    self.write(b': keepalive\n\n')
+                    await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+class StatsHandler(tornado.web.RequestHandler):
+
+    def get(self, *args, **kwargs):
+        self.write(json.dumps(dict(WSHandler.stats(), ingest=MainHandler.stats())))
+
+class MetricsHandler(tornado.web.RequestHandler):
+
+    def get(self, *args, **kwargs):
+        self.set_header('Content-Type', 'text/plain; version=0.0.4')
+        self.write(METRICS.render())
+
 
 if __name__ == '__main__':
+    worker = 0
+    if WORKERS > 1:
+        parent = os.getpid()
+        # Every worker binds its own listening socket, the kernel spreads connections between them
+        worker = tornado.process.fork_processes(WORKERS)
+        # Workers exit together with the process that forked them
+        tornado.ioloop.PeriodicCallback(
+            lambda: os.getppid() != parent and tornado.ioloop.IOLoop.current().stop(), 1000).start()
+    # Logging thread of this process, started after forking as threads do not survive fork
+    logs.setup()
     http_server = tornado.httpserver.HTTPServer(
         tornado.web.Application(
             [
                 (r'/ws',WSHandler),
+                (r'/stats', StatsHandler),
+                (r'/metrics', MetricsHandler),
+                (r'/events', EventsHandler),
+                (r'/events/stream', EventStreamHandler),
                 (r'/', MainHandler)
             ],
             websocket_ping_interval=10
         )
     )
-    http_server.listen(8182)
+    http_server.add_sockets(tornado.netutil.bind_sockets(PORT, reuse_port=WORKERS > 1))
+    if FANOUT_BACKEND == 'workers':
+        # Redeliveries received by another worker are caught by the repository owner
+        MainHandler.FANOUT = WorkerFanout(WORKERS_SOCKET_DIR, worker, WORKERS, WSHandler.broadcast,
+                                          Event.from_record, WORKERS_MAX_QUEUED,
+                                          admit=lambda event: MainHandler.DELIVERIES.admit(
+                                              event.headers.get('X-Github-Delivery')))
+    elif FANOUT_BACKEND == 'broker':
+        # Redeliveries received by another replica are dropped by every replica when relayed,
+        # in the same relay order everywhere. The ingest cache has already seen local ones.
+        relayed = DeliveryCache(DELIVERY_CACHE_SIZE, DELIVERY_CACHE_TTL)
+        MainHandler.FANOUT = BrokerFanout(FANOUT_BROKER, WSHandler.broadcast, Event.from_record,
+                                          FANOUT_BROKER_MAX_QUEUED,
+                                          admit=lambda event: relayed.admit(event.headers.get('X-Github-Delivery')))
+    if EVENT_LOG_DIR:
+        # Every worker broadcasts every event, so each one keeps a complete log of its own
+        log_dir = os.path.join(EVENT_LOG_DIR, 'worker-{}'.format(worker)) if WORKERS > 1 else EVENT_LOG_DIR
+        WSHandler.LOG = EventLog(log_dir, EVENT_LOG_SEGMENT_BYTES,
+                                 EVENT_LOG_RETENTION_BYTES, EVENT_LOG_RETENTION_SECONDS)
+        tornado.ioloop.PeriodicCallback(WSHandler.LOG.flush, 1000).start()
+    tornado.ioloop.IOLoop.current().spawn_callback(MainHandler.dispatch)
     tornado.ioloop.PeriodicCallback(WSHandler.heartbeat, 30000).start()
-    tornado.ioloop.IOLoop.instance().start()
\ No newline at end of file
+    tornado.ioloop.PeriodicCallback(WSHandler.ping_sessions, PING_RTT_INTERVAL * 1000).start()
+    tornado.ioloop.IOLoop.instance().start()
@@ -0,0 +1,53 @@
+import os
+import sys
+import unittest
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import tornado.websocket
+
+import server
+from server import SharedDeflate
+
+
+class TestSharedDeflate(unittest.TestCase):
+
+    def setUp(self):
+        SharedDeflate.clear()
+
+    def compressor(self, max_wbits=15):
+        return SharedDeflate(tornado.websocket._PerMessageDeflateCompressor(False, max_wbits), max_wbits)
+
+    def test_message_deflated_once_for_all_sessions(self):
+        message = b'{"payload": "' + b'x' * 4096 + b'"}'
+        first, second = self.compressor(), self.compressor()
+        deflated = first.compress(message)
+        self.assertIs(second.compress(message), deflated)
+        # every message can be inflated on its own, without the context of earlier ones
+        self.assertEqual(zlib.decompressobj(-15).decompress(deflated + b'\x00\x00\xff\xff'), message)
+
+    def test_sessions_with_other_window_deflate_again(self):
+        message = b'x' * 4096
+        self.compressor(15).compress(message)
+        self.compressor(10).compress(message)
+        self.assertEqual(len(SharedDeflate.CACHE), 2)
+
+    def test_cache_limited_by_bytes(self):
+        compressor = self.compressor()
+        messages = [bytes([i]) * (4 * 1024 * 1024) for i in range(20)]
+        for message in messages:
+            compressor.compress(message)
+        self.assertLessEqual(SharedDeflate.cached_bytes, server.WS_COMPRESSION_CACHE_BYTES)
+        self.assertEqual(SharedDeflate.cached_bytes, sum(len(x[1]) + len(y) for x, y in SharedDeflate.CACHE.items()))
+        self.assertIn((15, messages[-1]), SharedDeflate.CACHE)
+        self.assertNotIn((15, messages[0]), SharedDeflate.CACHE)
+
+    def test_latest_message_kept_over_limit(self):
+        message = b'x' * (server.WS_COMPRESSION_CACHE_BYTES + 1)
+        self.compressor().compress(message)
+        self.assertEqual(list(SharedDeflate.CACHE), [(15, message)])
+
+
+if __name__ == '__main__':
+    unittest.main()
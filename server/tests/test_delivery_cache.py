@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import DeliveryCache
+
+
+class TestDeliveryCache(unittest.TestCase):
+
+    def test_only_remembered_ids_are_seen(self):
+        cache = DeliveryCache(10, 60)
+        self.assertFalse(cache.seen('d1'))
+        # a rejected delivery is only looked up, its redelivery is not a duplicate
+        self.assertFalse(cache.seen('d1'))
+        cache.remember('d1')
+        self.assertTrue(cache.seen('d1'))
+
+    def test_hit_does_not_outlive_ttl(self):
+        cache = DeliveryCache(10, 0.2)
+        cache.remember('d1')
+        time.sleep(0.1)
+        cache.remember('d2')
+        self.assertTrue(cache.seen('d1'))
+        time.sleep(0.15)
+        self.assertFalse(cache.seen('d1'))
+        self.assertTrue(cache.seen('d2'))
+
+    def test_oldest_evicted_above_max_entries(self):
+        cache = DeliveryCache(2, 60)
+        for delivery_id in ('d1', 'd2', 'd3'):
+            cache.remember(delivery_id)
+        self.assertFalse(cache.seen('d1'))
+        self.assertTrue(cache.seen('d3'))
+
+    def test_admit_once(self):
+        cache = DeliveryCache(10, 60)
+        self.assertTrue(cache.admit('d1'))
+        self.assertFalse(cache.admit('d1'))
+        # webhooks without delivery id are always admitted
+        self.assertTrue(cache.admit(None))
+        self.assertTrue(cache.admit(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import json
+import os
+import sys
+import unittest
+import urllib.parse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from server import Event, RingBuffer
+
+HEADERS = {'X-Github-Event': 'push', 'Content-Type': 'application/json'}
+PAYLOAD = {'ref': 'refs/heads/main', 'repository': {'full_name': 'org/app'}, 'commits': [{'id': 'abc'}] * 50}
+PROJECTION = (('ref', 'repository.full_name'), ('x-github-event',))
+
+
+class TestEvent(unittest.TestCase):
+
+    def event(self):
+        return Event(HEADERS, bytearray(json.dumps(PAYLOAD).encode('utf-8')))
+
+    def test_released_event_encodes_same_frames(self):
+        live, released = self.event(), self.event()
+        released.id, released.timestamp = live.id, live.timestamp
+        released.release()
+        self.assertEqual(released.route, ('org/app', 'refs/heads/main', 'push'))
+        self.assertEqual(released.payload, PAYLOAD)
+        for envelope in ('v1', 'v2'):
+            for projection in (None, PROJECTION):
+                self.assertEqual(released.frame(envelope, projection), live.frame(envelope, projection))
+        # nothing decoded is kept once released
+        self.assertIsNone(released._payload)
+        self.assertEqual(released._projections, {})
+
+    def test_size_counts_form_encoded_document(self):
+        document = json.dumps(PAYLOAD)
+        body = urllib.parse.urlencode({'payload': document}).encode('utf-8')
+        event = Event(dict(HEADERS, **{'Content-Type': 'application/x-www-form-urlencoded'}), body)
+        self.assertEqual(event.size(), len(body) + len(document))
+        self.assertEqual(self.event().size(), len(json.dumps(PAYLOAD)))
+
+
+class TestRingBuffer(unittest.TestCase):
+
+    def test_evicts_oldest_over_max_bytes(self):
+        events = [Event(HEADERS, json.dumps({'n': i}).encode('utf-8')) for i in range(5)]
+        size = events[0].size()
+        buffer = RingBuffer(10, size * 3)
+        for event in events:
+            buffer.append(event)
+        self.assertEqual([x.id for x in buffer.after(None)], [x.id for x in events[2:]])
+        self.assertEqual([x.id for x in buffer.after(events[3].id)], [events[4].id])
+        # frames encoded for buffered events count as well
+        buffer.frame(events[4], 'v2', None)
+        self.assertLess(len(buffer), 3)
+        self.assertEqual(buffer.last_id(), events[4].id)
+        self.assertEqual(buffer.bytes, sum(x.size() for x in buffer.after(None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
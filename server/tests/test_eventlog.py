@@ -0,0 +1,112 @@
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from eventlog import EventLog
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def log(self, segment_bytes=4096, retention_bytes=1 << 20, retention_seconds=3600):
+        return EventLog(self.directory, segment_bytes, retention_bytes, retention_seconds)
+
+    def append(self, log, count, start=0):
+        for i in range(start, start + count):
+            log.append({'id': 'e{}'.format(i)}, b'x' * 100)
+
+    def ids(self, log, after=None):
+        return [meta['id'] for meta, data in log.read_after(after)]
+
+    def test_read_after(self):
+        log = self.log()
+        self.append(log, 5)
+        self.assertEqual(self.ids(log, 'e2'), ['e3', 'e4'])
+        self.assertEqual(self.ids(log, 'unknown'), ['e0', 'e1', 'e2', 'e3', 'e4'])
+        log.close()
+
+    def test_recover_after_restart(self):
+        log = self.log(segment_bytes=512)
+        self.append(log, 10)
+        log.close()
+        log = self.log(segment_bytes=512)
+        self.assertEqual(self.ids(log, 'e7'), ['e8', 'e9'])
+        self.append(log, 1, start=10)
+        self.assertEqual(self.ids(log, 'e9'), ['e10'])
+        log.close()
+
+    def test_recover_skips_empty_segment(self):
+        log = self.log()
+        self.append(log, 2)
+        log.close()
+        # a segment created but not preallocated before a crash
+        open(os.path.join(self.directory, '{:020d}.log'.format(2)), 'wb').close()
+        log = self.log()
+        self.assertEqual(self.ids(log), ['e0', 'e1'])
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+        log.close()
+
+    def test_recover_truncates_torn_record(self):
+        log = self.log()
+        self.append(log, 3)
+        segment, position, seq = log.index['e2']
+        log.close()
+        # the header of the last record reached the disk, its metadata did not
+        with open(segment.path, 'r+b') as f:
+            f.seek(position + 8)
+            f.write(bytes(20))
+        log = self.log()
+        self.assertEqual(self.ids(log), ['e0', 'e1'])
+        self.append(log, 1, start=3)
+        self.assertEqual(self.ids(log, 'e1'), ['e3'])
+        log.close()
+        log = self.log()
+        self.assertEqual(self.ids(log), ['e0', 'e1', 'e3'])
+        log.close()
+
+    def test_recover_stops_at_record_out_of_sequence(self):
+        log = self.log()
+        self.append(log, 3)
+        segment, position, seq = log.index['e2']
+        log.close()
+        with open(segment.path, 'r+b') as f:
+            f.seek(position + 8)
+            record = f.read(40)
+            f.seek(position + 8)
+            f.write(record.replace(b'"seq": 2', b'"seq": 7'))
+        log = self.log()
+        self.assertEqual(self.ids(log), ['e0', 'e1'])
+        self.assertEqual(log.append({'id': 'e3'}, b''), 2)
+        log.close()
+
+    def test_retention_bytes(self):
+        log = self.log(segment_bytes=512, retention_bytes=1024)
+        self.append(log, 20)
+        self.assertLessEqual(sum(x.size for x in log.segments), 1024)
+        self.assertEqual(self.ids(log)[-1], 'e19')
+        self.assertNotIn('e0', log.index)
+        log.close()
+
+    def test_idle_segments_age_out_on_flush(self):
+        log = self.log(segment_bytes=512, retention_seconds=0.1)
+        self.append(log, 6)
+        segments = len(log.segments)
+        self.assertGreater(segments, 1)
+        time.sleep(0.2)
+        log.flush()
+        self.assertEqual(len(log.segments), 1)
+        log.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
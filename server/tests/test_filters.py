@@ -0,0 +1,48 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filters import MAX_DEPTH, Filter, FilterError
+
+
+class FakeEvent(object):
+
+    def __init__(self, repository, ref, event, payload):
+        self.route = (repository, ref, event)
+        self.payload = payload
+
+
+PUSH = FakeEvent('org/app', 'refs/heads/main', 'push',
+                 {'pusher': {'name': 'alice'}, 'head_commit': {'message': 'fix: build please'}, 'forced': False})
+
+
+class TestFilter(unittest.TestCase):
+
+    def test_route_and_payload_fields(self):
+        self.assertTrue(Filter('ref == refs/heads/main && event == push')(PUSH))
+        self.assertTrue(Filter('repository =~ "org/*" && pusher.name != bot')(PUSH))
+        self.assertFalse(Filter('!(pusher.name == alice)')(PUSH))
+        self.assertTrue(Filter('event == release || head_commit.message =~ "*build please*"')(PUSH))
+        # payload values that are not strings compare as json
+        self.assertTrue(Filter('forced == false')(PUSH))
+        self.assertFalse(Filter('missing.path =~ "*"')(PUSH))
+
+    def test_operand_order_gives_same_key(self):
+        self.assertEqual(Filter('a == 1 && (b == 2 || c == 3)').key, Filter('(c == 3 || b == 2) && a == 1').key)
+
+    def test_invalid_filters(self):
+        for source in ('ref ==', 'ref refs/heads/main', '(ref == a', 'ref == a)', 'ref == a &&', '"unterminated', 5):
+            with self.assertRaises(FilterError, msg=source):
+                Filter(source)
+
+    def test_nesting_limited(self):
+        Filter('(' * MAX_DEPTH + 'a == b' + ')' * MAX_DEPTH)
+        for source in ('(' * 5000 + 'a == b' + ')' * 5000, '!' * 5000 + 'a == b'):
+            with self.assertRaises(FilterError):
+                Filter(source)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from filters import Filter
+from server import SubscriptionIndex
+
+
+class FakeEvent(object):
+
+    def __init__(self, repository, ref, event, payload=None):
+        self.route = (repository, ref, event)
+        self.payload = payload or {}
+
+
+class CountingFilter(object):
+
+    def __init__(self, expression):
+        self.filter = Filter(expression)
+        self.key = self.filter.key
+        self.calls = 0
+
+    def __call__(self, webhook):
+        self.calls += 1
+        return self.filter(webhook)
+
+
+class TestSubscriptionIndex(unittest.TestCase):
+
+    def test_exact_and_wildcard_keys(self):
+        index = SubscriptionIndex()
+        index.subscribe('all')
+        index.subscribe('repo', repositories=['org/app'])
+        index.subscribe('main', repositories=['org/app'], refs=['refs/heads/main'], events=['push'])
+        self.assertEqual(index.match('org/app', 'refs/heads/main', 'push'), {'all', 'repo', 'main'})
+        self.assertEqual(index.match('org/app', 'refs/heads/dev', 'push'), {'all', 'repo'})
+        self.assertEqual(index.match('org/lib', 'refs/heads/main', 'push'), {'all'})
+        self.assertTrue(index.accepts('main', 'org/app', 'refs/heads/main', 'push'))
+        self.assertFalse(index.accepts('main', 'org/app', 'refs/heads/main', 'create'))
+
+    def test_resubscribe_and_unsubscribe(self):
+        index = SubscriptionIndex()
+        index.subscribe('s', repositories=['org/app'])
+        index.subscribe('s', repositories=['org/lib'])
+        self.assertEqual(index.match('org/app', 'refs/heads/main', 'push'), set())
+        self.assertEqual(index.match('org/lib', 'refs/heads/main', 'push'), {'s'})
+        index.unsubscribe('s')
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.routes, {})
+
+    def test_same_filter_evaluated_once(self):
+        index = SubscriptionIndex()
+        expression = CountingFilter('pusher.name == alice')
+        for session in ('a', 'b', 'c'):
+            index.subscribe(session, expression=expression)
+        index.subscribe('other', expression=Filter('pusher.name == bob'))
+        index.subscribe('plain')
+        webhook = FakeEvent('org/app', 'refs/heads/main', 'push', {'pusher': {'name': 'alice'}})
+        self.assertEqual(index.match('org/app', 'refs/heads/main', 'push', webhook), {'a', 'b', 'c', 'plain'})
+        self.assertEqual(expression.calls, 1)
+        self.assertTrue(index.passes('a', webhook))
+        self.assertFalse(index.passes('other', webhook))
+        # filtered sessions are not matched without the event to evaluate against
+        self.assertEqual(index.match('org/app', 'refs/heads/main', 'push'), {'plain'})
+
+    def test_compiled_filters_released(self):
+        index = SubscriptionIndex()
+        index.subscribe('a', expression=Filter('event == push'))
+        index.subscribe('b', expression=Filter('event == push'))
+        index.unsubscribe('a')
+        self.assertEqual(len(index.compiled), 1)
+        index.unsubscribe('b')
+        self.assertEqual(index.compiled, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import server
+from server import TokenBuckets
+
+
+class TestTokenBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(server.time, 'monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_limited(self):
+        buckets = TokenBuckets(60, 3)
+        self.assertEqual([buckets.take('a') for _ in range(4)], [True, True, True, False])
+        self.assertAlmostEqual(buckets.delay('a'), 1)
+        # other keys have their own bucket
+        self.assertTrue(buckets.take('b'))
+        self.assertEqual(buckets.delay('unknown'), 0)
+
+    def test_refill_up_to_burst(self):
+        buckets = TokenBuckets(60, 2)
+        buckets.take('a')
+        buckets.take('a')
+        self.assertFalse(buckets.take('a'))
+        self.now += 0.5
+        self.assertAlmostEqual(buckets.delay('a'), 0.5)
+        self.now += 0.5
+        self.assertEqual(buckets.delay('a'), 0)
+        self.assertTrue(buckets.take('a'))
+        self.now += 3600
+        self.assertEqual([buckets.take('a') for _ in range(3)], [True, True, False])
+
+    def test_disabled(self):
+        buckets = TokenBuckets(0, 0)
+        self.assertTrue(all(buckets.take('a') for _ in range(100)))
+        self.assertEqual(buckets.stats(), {'keys': 0})
+
+    def test_least_recently_used_keys_forgotten(self):
+        buckets = TokenBuckets(60, 1, max_keys=2)
+        buckets.take('a')
+        buckets.take('b')
+        buckets.take('a')
+        buckets.take('c')
+        self.assertEqual(list(buckets.buckets), ['a', 'c'])
+        # a forgotten key starts again with a full bucket
+        self.assertTrue(buckets.take('b'))
+        self.assertEqual(buckets.stats(), {'keys': 2})
+
+
+if __name__ == '__main__':
+    unittest.main()